@@ -0,0 +1,301 @@
+import bisect
+import heapq
+import io
+import os
+from array import array
+
+import numpy as np
+
+from storage import write_file_atomic
+
+# Hourly buckets kept per (user, channel), 30 days is the longest /activity window
+HOURS_KEPT = 30 * 24
+# Messages in channels beyond a user's first few are counted under this channel id
+OTHER_CHANNEL = 0
+MAX_BUCKET_COUNT = np.iinfo(np.uint16).max
+
+
+class ActivityBuckets:
+    """Hourly message counts per (user, channel) for one guild.
+
+    Every (user, channel) pair owns one row of a uint16 matrix whose columns
+    are a ring of the last HOURS_KEPT hours, so memory per user is fixed no
+    matter how long the bot runs: at most `max_channels_per_user` channel rows
+    plus one OTHER_CHANNEL row.
+    """
+
+    def __init__(self, max_channels_per_user=8):
+        self.max_channels_per_user = max_channels_per_user
+        self.counts = np.zeros((16, HOURS_KEPT), dtype=np.uint16)
+        self.rows = {}
+        self.row_users = []
+        self.user_channels = {}
+        self.current_hour = None
+        # Called with (old_hour, new_hour) before expired buckets are cleared
+        self.expire_listeners = []
+
+    def _advance(self, hour):
+        """Move the ring forward to `hour`, clearing the buckets that fell out of it."""
+        if self.current_hour is None:
+            self.current_hour = hour
+            return
+        if hour <= self.current_hour:
+            return
+        for listener in self.expire_listeners:
+            listener(self.current_hour, hour)
+        used = len(self.rows)
+        if hour - self.current_hour >= HOURS_KEPT:
+            self.counts[:used] = 0
+        else:
+            columns = np.arange(self.current_hour + 1, hour + 1) % HOURS_KEPT
+            self.counts[:used, columns] = 0
+        self.current_hour = hour
+
+    def _row(self, user_id, channel_id):
+        row = self.rows.get((user_id, channel_id))
+        if row is not None:
+            return row
+        channels = self.user_channels.setdefault(user_id, [])
+        if channel_id != OTHER_CHANNEL and len(channels) >= self.max_channels_per_user:
+            return self._row(user_id, OTHER_CHANNEL)
+        row = len(self.rows)
+        if row == len(self.counts):
+            grown = np.zeros((row * 2, HOURS_KEPT), dtype=np.uint16)
+            grown[:row] = self.counts
+            self.counts = grown
+        self.rows[(user_id, channel_id)] = row
+        self.row_users.append(user_id)
+        channels.append(channel_id)
+        return row
+
+    def record(self, user_id, channel_id, timestamp, count=1):
+        hour = int(timestamp // 3600)
+        self._advance(hour)
+        if hour <= self.current_hour - HOURS_KEPT:
+            return
+        row = self._row(user_id, channel_id)
+        column = hour % HOURS_KEPT
+        self.counts[row, column] = min(int(self.counts[row, column]) + count, MAX_BUCKET_COUNT)
+
+    def _window_columns(self, hours, now):
+        self._advance(int(now // 3600))
+        hours = min(hours, HOURS_KEPT)
+        return np.arange(self.current_hour - hours + 1, self.current_hour + 1) % HOURS_KEPT
+
+    def channel_counts(self, user_id, hours, now):
+        """Messages per channel id sent by the user in the last `hours` hours."""
+        channels = self.user_channels.get(user_id, [])
+        if not channels:
+            return {}
+        columns = self._window_columns(hours, now)
+        rows = [self.rows[(user_id, channel_id)] for channel_id in channels]
+        sums = self.counts[np.ix_(rows, columns)].sum(axis=1, dtype=np.int64)
+        return {channel_id: int(total) for channel_id, total in zip(channels, sums) if total}
+
+    def user_count(self, user_id, hours, now):
+        return sum(self.channel_counts(user_id, hours, now).values())
+
+    def window_totals(self, hours, now):
+        """Messages per user id in the last `hours` hours, for every user at once."""
+        if not self.rows:
+            return {}
+        columns = self._window_columns(hours, now)
+        used = len(self.rows)
+        row_sums = self.counts[:used][:, columns].sum(axis=1, dtype=np.int64)
+        totals = {}
+        for (user_id, _), row in self.rows.items():
+            if row_sums[row]:
+                totals[user_id] = totals.get(user_id, 0) + int(row_sums[row])
+        return totals
+
+    def hour_totals(self, first_hour, last_hour):
+        """Messages per user id in hours first_hour..last_hour, which must still be in the ring."""
+        used = len(self.rows)
+        if not used or last_hour < first_hour:
+            return {}
+        columns = np.arange(first_hour, last_hour + 1) % HOURS_KEPT
+        row_sums = self.counts[:used][:, columns].sum(axis=1, dtype=np.int64)
+        totals = {}
+        for row in np.flatnonzero(row_sums).tolist():
+            user_id = self.row_users[row]
+            totals[user_id] = totals.get(user_id, 0) + int(row_sums[row])
+        return totals
+
+    def snapshot(self):
+        """Copy the counters so a worker thread can save them while the loop keeps counting."""
+        used = len(self.rows)
+        order = np.array(list(self.rows.values()), dtype=np.int64)
+        return {
+            "counts": self.counts[:used][order] if used else self.counts[:0].copy(),
+            "keys": np.array(list(self.rows), dtype=np.int64).reshape(-1, 2),
+            "current_hour": np.array([-1 if self.current_hour is None else self.current_hour]),
+        }
+
+    @classmethod
+    def from_bytes(cls, data, max_channels_per_user=8):
+        buckets = cls(max_channels_per_user)
+        with np.load(io.BytesIO(data)) as archive:
+            current_hour = int(archive["current_hour"][0])
+            buckets.current_hour = None if current_hour < 0 else current_hour
+            counts = archive["counts"]
+            # Rows that are all zero belong to users who went quiet, drop them
+            for (user_id, channel_id), row_counts in zip(archive["keys"].tolist(), counts):
+                if row_counts.any():
+                    row = buckets._row(user_id, channel_id)
+                    buckets.counts[row] = row_counts
+        return buckets
+
+
+class RankIndex:
+    """Users ranked by a non-negative count.
+
+    Users are grouped by count, the distinct counts are kept sorted, and a
+    Fenwick tree over count values tells how many users have at most a given
+    count. Updates and rank lookups cost O(log max_count), and top-K only
+    touches the groups it returns.
+    """
+
+    def __init__(self):
+        self.scores = {}
+        self.groups = {}
+        self.distinct = []
+        self.tree = array("q", [0]) * 1024
+
+    def __len__(self):
+        return len(self.scores)
+
+    def _tree_add(self, count, delta):
+        while count >= len(self.tree):
+            self._grow()
+        i = count + 1
+        size = len(self.tree)
+        while i < size:
+            self.tree[i] += delta
+            i += i & -i
+
+    def _grow(self):
+        old_size = len(self.tree)
+        self.tree.extend(array("q", [0]) * old_size)
+        # Nodes past the old end cover ranges that start inside it, fill them in
+        for i in range(old_size, len(self.tree)):
+            low = i - (i & -i)
+            if low < old_size - 1:
+                self.tree[i] = self._prefix(min(i, old_size - 1)) - self._prefix(low)
+
+    def _prefix(self, i):
+        total = 0
+        while i > 0:
+            total += self.tree[i]
+            i -= i & -i
+        return total
+
+    def count_at_most(self, count):
+        return self._prefix(min(count + 1, len(self.tree) - 1))
+
+    def _move(self, user_id, old, new):
+        if old:
+            group = self.groups[old]
+            group.discard(user_id)
+            if not group:
+                del self.groups[old]
+                del self.distinct[bisect.bisect_left(self.distinct, old)]
+            self._tree_add(old, -1)
+        if new:
+            group = self.groups.get(new)
+            if group is None:
+                group = self.groups[new] = set()
+                bisect.insort(self.distinct, new)
+            group.add(user_id)
+            self._tree_add(new, 1)
+
+    def add(self, user_id, delta):
+        old = self.scores.get(user_id, 0)
+        new = max(old + delta, 0)
+        if new == old:
+            return
+        if new:
+            self.scores[user_id] = new
+        else:
+            del self.scores[user_id]
+        self._move(user_id, old, new)
+
+    def clear(self):
+        self.__init__()
+
+    def score(self, user_id):
+        return self.scores.get(user_id, 0)
+
+    def rank(self, user_id):
+        """1-based rank, users tied on count share a rank. None if the user has no count."""
+        count = self.scores.get(user_id)
+        if count is None:
+            return None
+        return len(self.scores) - self.count_at_most(count) + 1
+
+    def top(self, k):
+        result = []
+        for count in reversed(self.distinct):
+            # Only the lowest user ids of a big tie are needed, don't sort all of them
+            for user_id in heapq.nsmallest(k - len(result), self.groups[count]):
+                result.append((user_id, count))
+            if len(result) == k:
+                return result
+        return result
+
+
+class ActivityLeaderboard:
+    """Lifetime and windowed message rankings for one guild.
+
+    The lifetime ranking gets +1 per message. Window rankings also get +1,
+    and when the hour rolls over the buckets that leave each window are
+    subtracted again, read from ActivityBuckets before it clears them.
+    """
+
+    def __init__(self, buckets, lifetime_counts, windows, now):
+        self.buckets = buckets
+        self.lifetime = RankIndex()
+        for user_id, count in lifetime_counts.items():
+            self.lifetime.add(user_id, count)
+        self.windows = {}
+        for hours in windows:
+            index = self.windows[hours] = RankIndex()
+            for user_id, count in buckets.window_totals(hours, now).items():
+                index.add(user_id, count)
+        buckets.expire_listeners.append(self._expire)
+
+    def _expire(self, old_hour, new_hour):
+        for hours, index in self.windows.items():
+            if new_hour - old_hour >= hours:
+                index.clear()
+                continue
+            # Hours old_hour-hours+1 .. new_hour-hours drop out of this window
+            for user_id, count in self.buckets.hour_totals(old_hour - hours + 1, new_hour - hours).items():
+                index.add(user_id, -count)
+
+    def record(self, user_id, channel_id, timestamp):
+        self.buckets.record(user_id, channel_id, timestamp)
+        self.lifetime.add(user_id, 1)
+        hour = int(timestamp // 3600)
+        for hours, index in self.windows.items():
+            if hour > self.buckets.current_hour - hours:
+                index.add(user_id, 1)
+
+    def ranking(self, hours=None, now=None):
+        """RankIndex for a window in hours, or the lifetime ranking when hours is None."""
+        if hours is None:
+            return self.lifetime
+        if now is not None:
+            self.buckets._advance(int(now // 3600))
+        return self.windows[hours]
+
+
+def load_activity_buckets(path, max_channels_per_user=8):
+    if os.path.exists(path):
+        with open(path, "rb") as file:
+            return ActivityBuckets.from_bytes(file.read(), max_channels_per_user)
+    return ActivityBuckets(max_channels_per_user)
+
+def save_activity_buckets(path, snapshot):
+    buffer = io.BytesIO()
+    np.savez_compressed(buffer, **snapshot)
+    write_file_atomic(path, buffer.getvalue())
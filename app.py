@@ -1,3 +1,7 @@
+import time
+# Taken before the heavy imports so /botstats can show the real time to ready
+STARTED_AT = time.perf_counter()
+
 import discord
 from discord.ext import commands
 from discord.ui import Button, View, Modal, TextInput
@@ -7,139 +11,374 @@ import os
 import random
 import datetime
 import pathlib
-import matplotlib.pyplot as plt
-import aiohttp
-import html
+import io
 import asyncio
-
-intents = discord.Intents.default()
-intents.message_content = True
-bot = commands.Bot(command_prefix="!", intents=intents)
+import signal
+import bisect
+import math
+import hashlib
+from collections import OrderedDict
+from routine import (
+    DAYS, RENDER_STYLES, RenderCache, RenderQueueFull, RoutineError, RoutineRenderer, build_routine,
+    format_routine_table, format_schedule, format_weekly_routine_table, parse_schedule, render_routine_cached
+)
+from voice import VoiceSessionTracker, append_voice_archive, compute_voice_stats, format_duration, load_voice_archive
+from activity import OTHER_CHANNEL, ActivityLeaderboard, load_activity_buckets, save_activity_buckets
+from trivia import (
+    DIFFICULTIES, FALLBACK_QUESTIONS, GENERAL_KNOWLEDGE, RESPONSE_TOKEN_EMPTY, RESPONSE_TOKEN_NOT_FOUND,
+    OpenTDBClient, OpenTDBError, QuestionBank, SeenFilter, TriviaGateway, TriviaPrefetcher, question_hash
+)
+from storage import AsyncStorage, GuildDataCache, WriteBehindWriter, create_backend, load_json_file, save_json_file
 
 DATA_ROOT = "guild_data"
 
-def get_guild_folder(guild_id):
-    folder = os.path.join(DATA_ROOT, str(guild_id))
-    os.makedirs(folder, exist_ok=True)
-    return folder
-
-def get_guild_file(guild_id, filename):
-    return os.path.join(get_guild_folder(guild_id), filename)
-
-def load_json_file(filepath, default=None):
-    if os.path.exists(filepath):
-        with open(filepath, "r", encoding="utf-8") as file:
-            return json.load(file)
-    return default if default is not None else {}
-
-def save_json_file(filepath, data):
-    with open(filepath, "w", encoding="utf-8") as file:
-        json.dump(data, file, indent=4)
-
-def load_game_data(guild_id):
-    return load_json_file(get_guild_file(guild_id, "game_usernames.json"), default={})
-
-def save_game_data(guild_id, game_usernames):
-    save_json_file(get_guild_file(guild_id, "game_usernames.json"), game_usernames)
-
-def load_routine_data(guild_id):
-    return load_json_file(get_guild_file(guild_id, "class_routine.json"), default={})
-
-def save_routine_data(guild_id, class_routine):
-    save_json_file(get_guild_file(guild_id, "class_routine.json"), class_routine)
-
-def load_activity_data(guild_id):
-    return load_json_file(get_guild_file(guild_id, "activity_data.json"), default={})
-
-def save_activity_data(guild_id, activity_data):
-    save_json_file(get_guild_file(guild_id, "activity_data.json"), activity_data)
-
-def load_voice_activity_data(guild_id):
-    return load_json_file(get_guild_file(guild_id, "voice_activity_data.json"), default={})
-
-def save_voice_activity_data(guild_id, activity_data):
-    save_json_file(get_guild_file(guild_id, "voice_activity_data.json"), activity_data)
-
-def load_mcq_data(guild_id):
-    return load_json_file(get_guild_file(guild_id, "mcq_scores.json"), default={})
-
-def save_mcq_data(guild_id, mcq_data):
-    save_json_file(get_guild_file(guild_id, "mcq_scores.json"), mcq_data)
-
-# These will be set per-guild in each command/event
-# Example: game_usernames[guild_id] = load_game_data(guild_id)
-game_usernames = {}
-class_routine = {}
-activity_data = {}
-voice_activity_data = {}
-mcq_scores = {}
-
-# Helper to get and cache per-guild data
-def ensure_guild_data(guild_id):
-    if guild_id not in game_usernames:
-        game_usernames[guild_id] = load_game_data(guild_id)
-    if guild_id not in class_routine:
-        class_routine[guild_id] = load_routine_data(guild_id)
-    if guild_id not in activity_data:
-        activity_data[guild_id] = load_activity_data(guild_id)
-    if guild_id not in voice_activity_data:
-        voice_activity_data[guild_id] = load_voice_activity_data(guild_id)
-    if guild_id not in mcq_scores:
-        mcq_scores[guild_id] = load_mcq_data(guild_id)
-
-def format_routine_table(day: str, schedule: str) -> str:
-    rows = schedule.split(", ")
-    table = f"**{day.capitalize()} Routine:**\n"
-    for idx, subject in enumerate(rows, 1):
-        table += f"**Period {idx}:** {subject}\n"
-    return table
-
-def format_weekly_routine_table(routine: dict) -> str:
-    days = ["Sunday", "Monday", "Tuesday", "Wednesday", "Thursday", "Friday"]
-    lines = []
-    for day in days:
-        schedule = routine.get(day.lower(), "")
-        periods = schedule.split(", ")
-        while len(periods) < 4:
-            periods.append("")
-        lines.append(f"{day}:")
-        for period_idx, subj in enumerate(periods):
-            sub_subjects = [s.strip() for s in subj.split("/") if s.strip()]
-            if sub_subjects:
-                lines.append(f"  Period {period_idx+1}: {sub_subjects[0]}")
-                for mini_subj in sub_subjects[1:]:
-                    lines.append(f"      {mini_subj}")
-            else:
-                lines.append(f"  Period {period_idx+1}: ")
-            if period_idx < 3:
-                lines.append("  --------")
-        lines.append("")
-    result = '```' + '\n'.join(lines).strip() + '```'
-    return result
+# Where guild data is stored: "json" (one file per dataset), "journal"
+# (JSON snapshots plus append-only journals) or "sqlite". A journal is compacted
+# into its snapshot once it is larger than both JOURNAL_COMPACT_BYTES and the snapshot
+STORAGE_BACKEND = os.getenv("STORAGE_BACKEND", "json")
+SQLITE_PATH = os.getenv("SQLITE_PATH", os.path.join(DATA_ROOT, "guild_data.sqlite3"))
+JOURNAL_COMPACT_BYTES = int(os.getenv("JOURNAL_COMPACT_BYTES", str(1024 * 1024)))
+
+# Bounds for the per-guild data cache, GUILD_CACHE_MAX_BYTES=0 means no byte limit
+GUILD_CACHE_MAX_ENTRIES = int(os.getenv("GUILD_CACHE_MAX_ENTRIES", "250"))
+GUILD_CACHE_MAX_BYTES = int(os.getenv("GUILD_CACHE_MAX_BYTES", "0"))
+
+# Hourly per-channel activity is tracked for at most this many channels per user.
+# The counters of the least recently active guilds are saved and unloaded
+# once all loaded guilds take more than ACTIVITY_BUCKETS_MAX_BYTES
+ACTIVITY_MAX_CHANNELS = int(os.getenv("ACTIVITY_MAX_CHANNELS", "8"))
+ACTIVITY_BUCKETS_MAX_BYTES = int(os.getenv("ACTIVITY_BUCKETS_MAX_BYTES", str(64 * 1024 * 1024)))
+
+# /activity time windows: choice -> (hours, label)
+ACTIVITY_WINDOWS = {
+    "24h": (24, "24 hours"),
+    "7d": (7 * 24, "7 days"),
+    "30d": (30 * 24, "30 days"),
+}
 
-@bot.event
-async def on_ready():
-    print(f"Bot is ready. Logged in as {bot.user}")
+# Local time used for /voicestats dates and busiest hours, in minutes from UTC
+UTC_OFFSET_MINUTES = int(os.getenv("UTC_OFFSET_MINUTES", "0"))
+
+# Voice sessions older than VOICE_LOG_MAX_AGE_DAYS, or beyond the newest
+# VOICE_LOG_MAX_SESSIONS per channel, move to compressed monthly archives.
+# Every VOICE_SWEEP_INTERVAL seconds open sessions are checked against who
+# is really in voice, which also closes sessions left open by a restart
+VOICE_LOG_MAX_AGE_DAYS = float(os.getenv("VOICE_LOG_MAX_AGE_DAYS", "7"))
+VOICE_LOG_MAX_SESSIONS = int(os.getenv("VOICE_LOG_MAX_SESSIONS", "1000"))
+VOICE_SWEEP_INTERVAL = float(os.getenv("VOICE_SWEEP_INTERVAL", "300"))
+
+# Voice channel summaries are queued and sent in batches, a batch longer
+# than VOICE_LOG_MAX_MESSAGES messages is sent as a text file instead
+VOICE_LOG_PUBLISH_INTERVAL = float(os.getenv("VOICE_LOG_PUBLISH_INTERVAL", "10"))
+VOICE_LOG_MAX_MESSAGES = int(os.getenv("VOICE_LOG_MAX_MESSAGES", "3"))
+
+# Rendered /routine and /routinepdf files are cached in memory up to
+# ROUTINE_CACHE_MAX_BYTES, and in ROUTINE_CACHE_DIR too (with the same
+# budget) when it is set
+ROUTINE_CACHE_MAX_BYTES = int(os.getenv("ROUTINE_CACHE_MAX_BYTES", str(16 * 1024 * 1024)))
+ROUTINE_CACHE_DIR = os.getenv("ROUTINE_CACHE_DIR", "")
+
+# Routines are rendered by a pool of worker processes. Renders beyond
+# ROUTINE_RENDER_QUEUE waiting or running are turned away, and a render
+# taking longer than ROUTINE_RENDER_TIMEOUT seconds is given up on
+ROUTINE_RENDER_WORKERS = int(os.getenv("ROUTINE_RENDER_WORKERS", "2"))
+ROUTINE_RENDER_QUEUE = int(os.getenv("ROUTINE_RENDER_QUEUE", "8"))
+ROUTINE_RENDER_TIMEOUT = float(os.getenv("ROUTINE_RENDER_TIMEOUT", "30"))
+
+# /gk questions are fetched ahead of time: when fewer than TRIVIA_LOW_WATER
+# are buffered for a difficulty, TRIVIA_BATCH_SIZE more are fetched
+TRIVIA_LOW_WATER = int(os.getenv("TRIVIA_LOW_WATER", "10"))
+TRIVIA_BATCH_SIZE = int(os.getenv("TRIVIA_BATCH_SIZE", "50"))
+# Per-request timeout in seconds and retries for OpenTDB calls
+TRIVIA_HTTP_TIMEOUT = float(os.getenv("TRIVIA_HTTP_TIMEOUT", "10"))
+TRIVIA_HTTP_RETRIES = int(os.getenv("TRIVIA_HTTP_RETRIES", "3"))
+# OpenTDB allows about one request per IP every 5 seconds
+TRIVIA_REQUEST_INTERVAL = float(os.getenv("TRIVIA_REQUEST_INTERVAL", "5"))
+# /gk waits at most TRIVIA_MAX_WAIT seconds for OpenTDB before using the local
+# question bank, which keeps every question fetched so far. TRIVIA_OFFLINE=1
+# only uses the bank. OPENTDB_URL can point at scripts/opentdb_stub.py
+TRIVIA_MAX_WAIT = float(os.getenv("TRIVIA_MAX_WAIT", "5"))
+TRIVIA_OFFLINE = os.getenv("TRIVIA_OFFLINE", "") == "1"
+TRIVIA_BANK_DIR = os.getenv("TRIVIA_BANK_DIR", os.path.join(DATA_ROOT, "trivia_bank"))
+OPENTDB_URL = os.getenv("OPENTDB_URL", "https://opentdb.com/api.php")
+
+# Activity counters are persisted in batches instead of on every message
+ACTIVITY_FLUSH_INTERVAL = float(os.getenv("ACTIVITY_FLUSH_INTERVAL", "10"))
+ACTIVITY_FLUSH_THRESHOLD = int(os.getenv("ACTIVITY_FLUSH_THRESHOLD", "500"))
+
+# Promotions are applied by a background queue and announced in batches
+ROLE_QUEUE_CONCURRENCY = int(os.getenv("ROLE_QUEUE_CONCURRENCY", "2"))
+PROMOTION_ANNOUNCE_INTERVAL = float(os.getenv("PROMOTION_ANNOUNCE_INTERVAL", "5"))
+
+class OGBot(commands.Bot):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.background_tasks = set()
+
+    def spawn(self, coro, name=None):
+        """Run `coro` in the background until it finishes or the bot closes, logging any error."""
+        task = asyncio.create_task(coro, name=name)
+        # The loop only keeps weak references to tasks
+        self.background_tasks.add(task)
+        task.add_done_callback(self._background_task_done)
+        return task
+
+    def _background_task_done(self, task):
+        self.background_tasks.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            print(f"Background task {task.get_name()} failed: {task.exception()!r}")
+
+    async def setup_hook(self):
+        activity_writer.start()
+        role_queue.start()
+        announcements.start()
+        voice_logs.start()
+        voice_sweeper.start()
+        routine_renderer.start()
+        await asyncio.to_thread(question_bank.load)
+        if not TRIVIA_OFFLINE:
+            # Shared buffer for DMs, and for guilds whose own buffer isn't filled yet
+            trivia_prefetcher.warm(GENERAL_KNOWLEDGE)
+        # Railway stops the container with SIGTERM, close cleanly so pending data is flushed
+        try:
+            self.loop.add_signal_handler(signal.SIGTERM, lambda: self.spawn(self.close(), name="close"))
+        except (NotImplementedError, RuntimeError):
+            pass
+
+    async def close(self):
+        # Close may itself be running as a background task after SIGTERM
+        tasks = [task for task in self.background_tasks if task is not asyncio.current_task()]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        await voice_sweeper.stop()
+        await trivia_prefetcher.stop()
+        await trivia_gateway.stop()
+        await trivia_client.close()
+        await role_queue.stop()
+        await announcements.stop()
+        await voice_logs.stop()
+        await activity_writer.stop()
+        await guild_cache.write_back_all()
+        await storage.close()
+        await routine_renderer.stop()
+        await super().close()
+
+intents = discord.Intents.default()
+intents.message_content = True
+bot = OGBot(command_prefix="!", intents=intents)
+
+# All guild_data reads and writes go through worker threads
+storage = AsyncStorage(create_backend(STORAGE_BACKEND, DATA_ROOT, SQLITE_PATH, JOURNAL_COMPACT_BYTES))
+
+async def load_game_data(guild_id):
+    return await storage.load(guild_id, "game_usernames")
+
+async def save_game_data(guild_id, game_usernames, keys=None):
+    await storage.save(guild_id, "game_usernames", game_usernames, keys)
+
+async def load_routine_data(guild_id):
+    return await storage.load(guild_id, "class_routine")
+
+async def save_routine_data(guild_id, class_routine, keys=None):
+    await storage.save(guild_id, "class_routine", class_routine, keys)
+
+async def load_activity_data(guild_id):
+    return await storage.load(guild_id, "activity_data")
+
+async def save_activity_data(guild_id, activity_data, keys=None):
+    await storage.save(guild_id, "activity_data", activity_data, keys)
+
+async def load_voice_activity_data(guild_id):
+    return await storage.load(guild_id, "voice_activity_data")
+
+async def save_voice_activity_data(guild_id, activity_data, keys=None):
+    await storage.save(guild_id, "voice_activity_data", activity_data, keys)
+
+async def load_promotion_settings(guild_id):
+    return await storage.load(guild_id, "promotion_settings")
+
+async def save_promotion_settings(guild_id, settings, keys=None):
+    await storage.save(guild_id, "promotion_settings", settings, keys)
+
+async def load_mcq_data(guild_id):
+    return await storage.load(guild_id, "mcq_scores")
+
+async def save_mcq_data(guild_id, mcq_data, keys=None):
+    await storage.save(guild_id, "mcq_scores", mcq_data, keys)
+
+async def save_trivia_session(guild_id, session, keys=None):
+    await storage.save(guild_id, "trivia_session", session, keys)
+
+async def save_trivia_seen(guild_id, seen_filters, keys=None):
+    await storage.save(guild_id, "trivia_seen", seen_filters, keys)
+
+# Per-guild data is loaded lazily into a bounded LRU cache.
+# The module-level names are dict-like views, e.g. game_usernames[guild_id]
+guild_cache = GuildDataCache(storage, max_entries=GUILD_CACHE_MAX_ENTRIES, max_bytes=GUILD_CACHE_MAX_BYTES)
+game_usernames = guild_cache.view("game_usernames")
+class_routine = guild_cache.view("class_routine")
+activity_data = guild_cache.view("activity_data")
+voice_activity_data = guild_cache.view("voice_activity_data")
+mcq_scores = guild_cache.view("mcq_scores")
+promotion_settings = guild_cache.view("promotion_settings")
+trivia_session = guild_cache.view("trivia_session")
+trivia_seen = guild_cache.view("trivia_seen")
+
+async def ensure_guild_data(guild_id, *datasets):
+    """Make sure the given datasets of a guild are loaded into the cache."""
+    for dataset in datasets:
+        await guild_cache.load(dataset, guild_id)
+
+# Hourly message counters per guild, see activity.ActivityBuckets, least
+# recently used first. Every load and save of them goes through
+# activity_buckets_io, so a guild unloaded while its counters are still being
+# saved is only loaded again from the saved file
+activity_buckets = OrderedDict()
+activity_buckets_io = asyncio.Lock()
+activity_buckets_evictions = 0
+
+def get_activity_buckets_file(guild_id):
+    return os.path.join(DATA_ROOT, str(guild_id), "activity_buckets.npz")
+
+def activity_buckets_bytes():
+    return sum(buckets.counts.nbytes for buckets in activity_buckets.values())
+
+async def save_guild_activity_buckets(guild_id, buckets):
+    async with activity_buckets_io:
+        await asyncio.to_thread(save_activity_buckets, get_activity_buckets_file(guild_id), buckets.snapshot())
+
+async def evict_activity_buckets():
+    """Save and unload the least recently used guilds' counters until they fit ACTIVITY_BUCKETS_MAX_BYTES."""
+    global activity_buckets_evictions
+    # The most recently used guild always stays, it is the one being worked on
+    while len(activity_buckets) > 1 and activity_buckets_bytes() > ACTIVITY_BUCKETS_MAX_BYTES:
+        guild_id, buckets = activity_buckets.popitem(last=False)
+        # The leaderboard is kept up to date from these buckets, it has to go with them
+        activity_leaderboards.pop(guild_id, None)
+        activity_buckets_evictions += 1
+        await save_guild_activity_buckets(guild_id, buckets)
+
+async def get_activity_buckets(guild_id):
+    buckets = activity_buckets.get(guild_id)
+    if buckets is None:
+        async with activity_buckets_io:
+            loaded = await asyncio.to_thread(
+                load_activity_buckets, get_activity_buckets_file(guild_id), ACTIVITY_MAX_CHANNELS
+            )
+        buckets = activity_buckets.setdefault(guild_id, loaded)
+        activity_buckets.move_to_end(guild_id)
+        await evict_activity_buckets()
+    else:
+        activity_buckets.move_to_end(guild_id)
+    return buckets
+
+# Incrementally maintained message rankings per guild, built on first use
+activity_leaderboards = {}
+
+async def get_activity_leaderboard(guild_id):
+    leaderboard = activity_leaderboards.get(guild_id)
+    while leaderboard is None:
+        buckets = await get_activity_buckets(guild_id)
+        await ensure_guild_data(guild_id, "activity_data")
+        leaderboard = activity_leaderboards.get(guild_id)
+        if leaderboard is None and activity_buckets.get(guild_id) is buckets:
+            lifetime_counts = {int(user_id): stats.get("messages", 0) for user_id, stats in activity_data[guild_id].items()}
+            windows = [hours for hours, _ in ACTIVITY_WINDOWS.values()]
+            leaderboard = activity_leaderboards[guild_id] = ActivityLeaderboard(buckets, lifetime_counts, windows, time.time())
+    activity_buckets.move_to_end(guild_id)
+    return leaderboard
+
+async def flush_activity_data(guild_id, user_ids):
+    await guild_cache.write_back("activity_data", guild_id, keys=user_ids)
+    buckets = activity_buckets.get(guild_id)
+    if buckets is not None:
+        await save_guild_activity_buckets(guild_id, buckets)
+
+activity_writer = WriteBehindWriter(
+    flush_activity_data,
+    interval=ACTIVITY_FLUSH_INTERVAL,
+    max_pending=ACTIVITY_FLUSH_THRESHOLD
+)
+
+# Parsed routines per guild, see routine.build_routine. Rebuilt by /changeday
+routine_models = {}
+
+async def get_routine_model(guild_id):
+    model = routine_models.get(guild_id)
+    if model is None:
+        await ensure_guild_data(guild_id, "class_routine")
+        model = routine_models.setdefault(guild_id, build_routine(class_routine[guild_id]))
+    return model
+
+# Hash of the slash commands as last synced with Discord, so restarts without
+# command changes skip the slow and rate limited tree sync
+COMMAND_SYNC_FILE = os.path.join(DATA_ROOT, "command_sync.json")
+FORCE_COMMAND_SYNC = os.getenv("FORCE_COMMAND_SYNC", "") == "1"
+
+startup_stats = {"ready_seconds": None, "sync": "not yet", "sync_seconds": 0.0}
+
+def command_tree_hash():
+    commands_data = sorted((command.to_dict(bot.tree) for command in bot.tree.get_commands()), key=lambda data: data["name"])
+    payload = json.dumps([bot.application_id, commands_data], sort_keys=True, default=str)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+async def sync_command_tree():
+    tree_hash = command_tree_hash()
+    synced_hash = (await asyncio.to_thread(load_json_file, COMMAND_SYNC_FILE)).get("hash")
+    if tree_hash == synced_hash and not FORCE_COMMAND_SYNC:
+        startup_stats["sync"] = "skipped, commands unchanged"
+        print("Slash commands unchanged since the last sync, skipping it.")
+        return
+    started = time.perf_counter()
     try:
         synced = await bot.tree.sync()
-        print(f"Synced {len(synced)} slash commands.")
     except Exception as e:
+        startup_stats["sync"] = "failed"
         print(f"Failed to sync commands: {e}")
+        return
+    startup_stats["sync_seconds"] = time.perf_counter() - started
+    startup_stats["sync"] = f"synced {len(synced)} commands"
+    print(f"Synced {len(synced)} slash commands.")
+    await asyncio.to_thread(save_json_file, COMMAND_SYNC_FILE, {"hash": tree_hash})
 
 @bot.event
-async def on_guild_join(guild):
-    ensure_guild_data(guild.id)
+async def on_ready():
+    print(f"Bot is ready. Logged in as {bot.user}")
+    # on_ready also fires after reconnects, only do the startup work once per run
+    if startup_stats["ready_seconds"] is None:
+        startup_stats["ready_seconds"] = time.perf_counter() - STARTED_AT
+        print(f"Ready {startup_stats['ready_seconds']:.2f}s after start.")
+        await sync_command_tree()
+    for guild in bot.guilds:
+        if guild.id not in reconciled_guilds:
+            reconciled_guilds.add(guild.id)
+            bot.spawn(run_startup_reconciliation(guild), name=f"reconcile-{guild.id}")
+            if not TRIVIA_OFFLINE:
+                # /gk draws from a buffer per guild, fetched with the guild's session token
+                trivia_prefetcher.warm(GENERAL_KNOWLEDGE, scope=guild.id)
 
 @bot.event
-async def on_guild_available(guild):
-    ensure_guild_data(guild.id)
+async def on_guild_join(guild):
+    if not TRIVIA_OFFLINE:
+        trivia_prefetcher.warm(GENERAL_KNOWLEDGE, scope=guild.id)
+
+reconciled_guilds = set()
+
+async def run_startup_reconciliation(guild):
+    try:
+        checked, promoted = await reconcile_promotions(guild)
+        if promoted:
+            print(f"Startup role sweep for {guild.name}: checked {checked} members, queued {promoted} promotions.")
+    except Exception as e:
+        print(f"Startup role sweep failed for {guild.name}: {e}")
 
 
 @bot.tree.command(name="addgame", description="Add or update a game username for a user")
 @app_commands.describe(game_name="The name of the game", username="Your username in the game", member="The user to add the game for (optional)")
 async def add_game(interaction: discord.Interaction, game_name: str, username: str, member: discord.User = None):
     guild_id = interaction.guild.id
-    ensure_guild_data(guild_id)
+    await ensure_guild_data(guild_id, "game_usernames")
 
     if not member:
         member = interaction.user
@@ -154,14 +393,14 @@ async def add_game(interaction: discord.Interaction, game_name: str, username: s
     if game_name not in game_usernames[guild_id]:
         game_usernames[guild_id][game_name] = {}
     game_usernames[guild_id][game_name][user_id] = username
-    save_game_data(guild_id, game_usernames[guild_id])
+    await save_game_data(guild_id, game_usernames[guild_id], keys=[game_name])
     await interaction.response.send_message(f"Added/Updated username for {member.name} in game '{game_name}'.")
 
 @bot.tree.command(name="view", description="View all registered usernames of a specific game")
 @app_commands.describe(game_name="The name of the game to view usernames for")
 async def view_usernames(interaction: discord.Interaction, game_name: str):
     guild_id = interaction.guild.id
-    ensure_guild_data(guild_id)
+    await ensure_guild_data(guild_id, "game_usernames")
 
     game_name = game_name.lower()
 
@@ -178,7 +417,7 @@ async def view_usernames(interaction: discord.Interaction, game_name: str):
 @bot.tree.command(name="games", description="List all games with usernames")
 async def list_games(interaction: discord.Interaction):
     guild_id = interaction.guild.id
-    ensure_guild_data(guild_id)
+    await ensure_guild_data(guild_id, "game_usernames")
 
     if not game_usernames[guild_id]:
         await interaction.response.send_message("No games have been added yet.")
@@ -193,7 +432,7 @@ async def list_games(interaction: discord.Interaction):
 @app_commands.describe(member="The user to view the usernames of")
 async def view_user_usernames(interaction: discord.Interaction, member: discord.User):
     guild_id = interaction.guild.id
-    ensure_guild_data(guild_id)
+    await ensure_guild_data(guild_id, "game_usernames")
     user_id = str(member.id)
     user_games = [
         (game, users[user_id])
@@ -214,34 +453,29 @@ async def view_user_usernames(interaction: discord.Interaction, member: discord.
 @app_commands.describe(day="Day of the week (e.g., sunday, monday, ...)")
 async def routine_day(interaction: discord.Interaction, day: str):
     guild_id = interaction.guild.id
-    ensure_guild_data(guild_id)
     day_lower = day.lower()
-    valid_days = ["sunday", "monday", "tuesday", "wednesday", "thursday", "friday"]
-    if day_lower not in valid_days:
+    if day_lower not in DAYS:
         await interaction.response.send_message(
             "Invalid day. Please choose from: Sunday, Monday, Tuesday, Wednesday, Thursday, Friday.",
             ephemeral=True
         )
         return
-    schedule = class_routine[guild_id].get(day_lower, "No routine found.")
-    table = format_routine_table(day.capitalize(), schedule)
+    routine = await get_routine_model(guild_id)
+    table = format_routine_table(day_lower, routine[day_lower])
     await interaction.response.send_message(table)
 
 @bot.tree.command(name="routineweek", description="View the entire week's class routine as text.")
 async def routineweek_slash(interaction: discord.Interaction):
     guild_id = interaction.guild.id
-    ensure_guild_data(guild_id)
-    table = format_weekly_routine_table(class_routine[guild_id])
+    table = format_weekly_routine_table(await get_routine_model(guild_id))
     await interaction.response.send_message(table, ephemeral=True)
 
 @bot.tree.command(name="changeday", description="Change the routine for a specific day")
-@app_commands.describe(day="Day of the week (e.g., sunday, monday, ...)", schedule="The new schedule for the day")
+@app_commands.describe(day="Day of the week (e.g., sunday, monday, ...)", schedule="Up to 4 periods separated by commas, e.g. Maths, Physics (A) / Chemistry (B), English")
 async def change_day(interaction: discord.Interaction, day: str, schedule: str):
     guild_id = interaction.guild.id
-    ensure_guild_data(guild_id)
-    valid_days = ["sunday", "monday", "tuesday", "wednesday", "thursday", "friday"]
     day_lower = day.lower()
-    if day_lower not in valid_days:
+    if day_lower not in DAYS:
         await interaction.response.send_message(
             "Invalid day. Please choose from: Sunday, Monday, Tuesday, Wednesday, Thursday, Friday.",
             ephemeral=True
@@ -250,10 +484,22 @@ async def change_day(interaction: discord.Interaction, day: str, schedule: str):
     if not interaction.user.guild_permissions.administrator:
         await interaction.response.send_message("You do not have permission to modify the routine.", ephemeral=True)
         return
-    class_routine[guild_id][day_lower] = schedule
-    save_routine_data(guild_id, class_routine[guild_id])
+    try:
+        periods = parse_schedule(schedule)
+    except RoutineError as e:
+        await interaction.response.send_message(f"Invalid schedule: {e}", ephemeral=True)
+        return
+    await ensure_guild_data(guild_id, "class_routine")
+    old_routine = await get_routine_model(guild_id)
+    class_routine[guild_id][day_lower] = format_schedule(periods)
+    routine = routine_models[guild_id] = {**old_routine, day_lower: periods}
+    await save_routine_data(guild_id, class_routine[guild_id], keys=[day_lower])
     await interaction.response.send_message(f"{day.capitalize()}'s routine updated successfully!")
+    # Renders of the old routine stay cached, other guilds may have the same one
+    prewarm_routine_renders(routine)
 
+# Default ladder for guilds that haven't configured their own with /setpromotion
+DEFAULT_ROLES_CHANNEL_ID = 1309835417570377728
 PROMOTIONS = {
     "The Boys": ("The Men", 102),
     "The Girls": ("The Ladies", 102),
@@ -267,50 +513,640 @@ async def on_message(message):
         return
 
     guild_id = message.guild.id
-    ensure_guild_data(guild_id)
+    # A new leaderboard starts from the stored counts, so get it before this message is counted
+    leaderboard = await get_activity_leaderboard(guild_id)
+    # Loaded last, nothing is awaited between here and reading the counts below
+    await ensure_guild_data(guild_id, "activity_data")
     user_id = str(message.author.id)
 
     if user_id not in activity_data[guild_id]:
         activity_data[guild_id][user_id] = {"messages": 0}
 
     activity_data[guild_id][user_id]["messages"] += 1
-    save_activity_data(guild_id, activity_data[guild_id])
+    # Mark before awaiting anything, an evicted entry is only written back if it is dirty
+    guild_cache.mark_dirty("activity_data", guild_id)
+    activity_writer.mark_dirty(guild_id, user_id)
+    leaderboard.record(message.author.id, message.channel.id, message.created_at.timestamp())
 
     await check_promotion(message.author, message.guild, guild_id)
     await bot.process_commands(message)
 
+def chunk_lines(lines, limit=2000):
+    """Join lines into as few messages as possible without going over Discord's limit."""
+    chunks = []
+    current = ""
+    for line in lines:
+        while len(line) > limit:
+            if current:
+                chunks.append(current)
+                current = ""
+            chunks.append(line[:limit])
+            line = line[limit:]
+        if current and len(current) + 1 + len(line) > limit:
+            chunks.append(current)
+            current = line
+        else:
+            current = f"{current}\n{line}" if current else line
+    if current:
+        chunks.append(current)
+    return chunks
+
+class ChannelPublisher:
+    """Queues text per channel and sends it every `interval` seconds in as few messages as possible.
+
+    When a channel's batch would take more than `max_messages` messages it is
+    sent as a single text file attachment instead.
+    """
+
+    def __init__(self, interval=5.0, max_messages=None, allowed_mentions=None, attachment_name="log.txt"):
+        self.interval = interval
+        self.max_messages = max_messages
+        self.allowed_mentions = allowed_mentions
+        self.attachment_name = attachment_name
+        self.queues = {}
+        self.sent = 0
+        self.attachments = 0
+        self._wakeup = None
+        self._stopping = False
+        self._task = None
+
+    def publish(self, channel, text):
+        self.queues.setdefault(channel.id, (channel, []))[1].append(text)
+
+    def backlog(self):
+        return sum(len(lines) for _, lines in self.queues.values())
+
+    async def flush(self):
+        batch, self.queues = self.queues, {}
+        try:
+            while batch:
+                channel, texts = next(iter(batch.values()))
+                lines = [line for text in texts for line in text.split("\n")]
+                chunks = chunk_lines(lines)
+                try:
+                    if self.max_messages and len(chunks) > self.max_messages:
+                        file = discord.File(io.BytesIO("\n".join(lines).encode("utf-8")), filename=self.attachment_name)
+                        await channel.send(file=file)
+                        self.attachments += 1
+                    else:
+                        for i, chunk in enumerate(chunks):
+                            if self.allowed_mentions is None:
+                                await channel.send(chunk)
+                            else:
+                                await channel.send(chunk, allowed_mentions=self.allowed_mentions)
+                            self.sent += 1
+                            texts[:] = chunks[i + 1:]
+                except discord.HTTPException as e:
+                    print(f"Failed to send to channel {channel.id}: {e}")
+                del batch[channel.id]
+        finally:
+            # Only left over when cancelled, what wasn't sent yet goes out first next time
+            for channel_id, (channel, texts) in batch.items():
+                self.queues.setdefault(channel_id, (channel, []))[1][:0] = texts
+
+    async def _run(self):
+        while not self._stopping:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.interval)
+            except asyncio.TimeoutError:
+                pass
+            await self.flush()
+
+    def start(self):
+        if self._task is None:
+            self._wakeup = asyncio.Event()
+            self._stopping = False
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            # Let a flush that is already sending finish instead of cancelling it
+            self._stopping = True
+            self._wakeup.set()
+            await self._task
+            self._task = None
+        await self.flush()
+
+class RoleChangeQueue:
+    """Applies role changes in the background with a bounded number of concurrent requests.
+
+    Changes queued for the same member are merged, and each member gets one
+    edit that removes and adds roles at once instead of two separate calls.
+    discord.py already waits out rate limits per route; requests that still
+    fail with 429 or a server error are retried with backoff.
+    """
+
+    def __init__(self, concurrency=2, max_retries=3, reason=None):
+        self.concurrency = concurrency
+        self.max_retries = max_retries
+        self.reason = reason
+        self.pending = {}
+        self.queue = asyncio.Queue()
+        self.workers = []
+        self.applied = 0
+        self.merged = 0
+        self.retries = 0
+        self.failed = 0
+
+    def is_pending(self, member):
+        return (member.guild.id, member.id) in self.pending
+
+    def submit(self, member, add=(), remove=(), on_applied=None):
+        key = (member.guild.id, member.id)
+        change = self.pending.get(key)
+        if change is None:
+            change = self.pending[key] = {"member": member, "add": set(), "remove": set(), "on_applied": []}
+            self.queue.put_nowait(key)
+        else:
+            change["member"] = member
+            self.merged += 1
+        for role_id in remove:
+            change["add"].discard(role_id)
+            change["remove"].add(role_id)
+        for role_id in add:
+            change["remove"].discard(role_id)
+            change["add"].add(role_id)
+        if on_applied:
+            change["on_applied"].append(on_applied)
+
+    async def _apply(self, change):
+        member = change["member"]
+        # Prefer the cached member so roles changed since submit aren't reverted
+        member = member.guild.get_member(member.id) or member
+        roles = [role for role in member.roles if not role.is_default() and role.id not in change["remove"]]
+        for role_id in change["add"]:
+            role = member.guild.get_role(role_id)
+            if role and role not in roles:
+                roles.append(role)
+        for attempt in range(self.max_retries + 1):
+            try:
+                await member.edit(roles=roles, reason=self.reason)
+                break
+            except discord.HTTPException as e:
+                if (e.status != 429 and e.status < 500) or attempt == self.max_retries:
+                    self.failed += 1
+                    print(f"Failed to update roles for {member}: {e}")
+                    return
+                self.retries += 1
+                await asyncio.sleep(2 ** attempt + random.random())
+        self.applied += 1
+        for callback in change["on_applied"]:
+            callback()
+
+    async def _worker(self):
+        while True:
+            key = await self.queue.get()
+            change = self.pending.pop(key, None)
+            try:
+                if change:
+                    await self._apply(change)
+            except asyncio.CancelledError:
+                if change:
+                    print(f"Role change for {change['member']} interrupted by shutdown")
+                raise
+            except Exception as e:
+                print(f"Error applying role change: {e}")
+            finally:
+                self.queue.task_done()
+
+    def start(self):
+        if not self.workers:
+            self.workers = [asyncio.create_task(self._worker()) for _ in range(self.concurrency)]
+
+    async def stop(self, timeout=10.0):
+        """Apply what is queued for up to `timeout` seconds, then drop the rest."""
+        if self.workers:
+            try:
+                await asyncio.wait_for(self.queue.join(), timeout)
+            except asyncio.TimeoutError:
+                pass
+        for worker in self.workers:
+            worker.cancel()
+        await asyncio.gather(*self.workers, return_exceptions=True)
+        self.workers = []
+        if self.pending:
+            print(f"Dropped {len(self.pending)} queued role changes on shutdown: {', '.join(str(change['member']) for change in self.pending.values())}")
+            self.pending.clear()
+
+    def stats(self):
+        return {
+            "backlog": len(self.pending),
+            "applied": self.applied,
+            "merged": self.merged,
+            "retries": self.retries,
+            "failed": self.failed,
+        }
+
+role_queue = RoleChangeQueue(concurrency=ROLE_QUEUE_CONCURRENCY, reason="Auto-promotion")
+announcements = ChannelPublisher(interval=PROMOTION_ANNOUNCE_INTERVAL)
+# Voice channel summaries, sent from the background so voice events never wait on Discord
+voice_logs = ChannelPublisher(
+    interval=VOICE_LOG_PUBLISH_INTERVAL,
+    max_messages=VOICE_LOG_MAX_MESSAGES,
+    allowed_mentions=discord.AllowedMentions.none(),
+    attachment_name="voice_log.txt"
+)
+
+class PromotionIndex:
+    """Promotion ladders of one guild, keyed by the role a member must have.
+
+    Each ladder is sorted by threshold, and the next threshold of every member
+    we've seen is memoized together with the roles it was computed from, so
+    most messages only cost one comparison and a role change (which we don't
+    get events for without the members intent) simply misses the memo.
+    """
+
+    def __init__(self, steps, channel_id):
+        ladders = {}
+        for current_role_id, new_role_id, threshold in steps:
+            ladders.setdefault(current_role_id, []).append((threshold, new_role_id))
+        self.ladders = {}
+        for current_role_id, ladder in ladders.items():
+            ladder.sort()
+            self.ladders[current_role_id] = ([t for t, _ in ladder], [r for _, r in ladder])
+        self.min_threshold = min((t[0] for t, _ in self.ladders.values()), default=math.inf)
+        self.channel_id = channel_id
+        self.next_thresholds = {}
+
+    def next_threshold(self, role_ids):
+        return min((self.ladders[r][0][0] for r in role_ids if r in self.ladders), default=math.inf)
+
+    def promotion_for(self, role_ids, message_count):
+        """Return (current_role_id, new_role_id) for the highest step reached, if any."""
+        for role_id in role_ids:
+            if role_id not in self.ladders:
+                continue
+            thresholds, new_role_ids = self.ladders[role_id]
+            idx = bisect.bisect_right(thresholds, message_count)
+            if idx:
+                return role_id, new_role_ids[idx - 1]
+        return None
+
+    def promotion_plan(self, role_ids, message_count):
+        """Follow the ladders as far as message_count allows.
+
+        Returns (removed role ids, added role ids, final new role id), or None.
+        """
+        original = set(role_ids)
+        final = set(role_ids)
+        seen = set(role_ids)
+        new_role_id = None
+        while True:
+            step = self.promotion_for(final, message_count)
+            # Stop on ladders that loop back to a role we've already had
+            if step is None or step[1] in seen:
+                break
+            final.discard(step[0])
+            final.add(step[1])
+            seen.add(step[1])
+            new_role_id = step[1]
+        if new_role_id is None:
+            return None
+        return original - final, final - original, new_role_id
+
+# Built lazily per guild and dropped whenever roles or promotion settings change
+promotion_indexes = {}
+
+def build_promotion_index(guild):
+    settings = promotion_settings[guild.id]
+    steps = []
+    if "ladder" in settings:
+        for current_role_id, ladder in settings["ladder"].items():
+            for step in ladder:
+                if guild.get_role(int(current_role_id)) and guild.get_role(step["role"]):
+                    steps.append((int(current_role_id), step["role"], step["threshold"]))
+    else:
+        for current_role_name, (new_role_name, threshold) in PROMOTIONS.items():
+            current_role = discord.utils.get(guild.roles, name=current_role_name)
+            new_role = discord.utils.get(guild.roles, name=new_role_name)
+            if current_role and new_role:
+                steps.append((current_role.id, new_role.id, threshold))
+    return PromotionIndex(steps, settings.get("channel_id", DEFAULT_ROLES_CHANNEL_ID))
+
+async def get_promotion_index(guild):
+    index = promotion_indexes.get(guild.id)
+    if index is None:
+        await ensure_guild_data(guild.id, "promotion_settings")
+        index = promotion_indexes[guild.id] = build_promotion_index(guild)
+    return index
+
 async def check_promotion(member, guild, guild_id):
     """Check if a user qualifies for promotion."""
     user_id = str(member.id)
     user_activity = activity_data[guild_id].get(user_id, {})
     message_count = user_activity.get("messages", 0)
 
-    roles_channel = guild.get_channel(1309835417570377728)
-    if not roles_channel:
+    index = await get_promotion_index(guild)
+    if message_count < index.min_threshold or role_queue.is_pending(member):
+        return
+    role_ids = [role.id for role in member.roles]
+    role_key = frozenset(role_ids)
+    memo = index.next_thresholds.get(member.id)
+    if memo is None or memo[0] != role_key:
+        memo = index.next_thresholds[member.id] = (role_key, index.next_threshold(role_ids))
+    if message_count < memo[1]:
+        return
+
+    queue_promotion(member, guild, index, role_ids, message_count)
+
+def queue_promotion(member, guild, index, role_ids, message_count):
+    """Queue every promotion the member has earned, returns False if there is none."""
+    plan = index.promotion_plan(role_ids, message_count)
+    if plan is None:
+        return False
+    removed, added, new_role_id = plan
+    # Memoize for the roles after the change, if it fails the roles won't match and it is retried
+    final_role_ids = [role_id for role_id in role_ids if role_id not in removed] + list(added)
+    index.next_thresholds[member.id] = (frozenset(final_role_ids), index.next_threshold(final_role_ids))
+
+    new_role = guild.get_role(new_role_id)
+    roles_channel = guild.get_channel(index.channel_id)
+    on_applied = None
+    if roles_channel:
+        on_applied = lambda: announcements.publish(
+            roles_channel, f"🎉 Congratulations {member.mention}! You've been promoted to **{new_role.name}**!"
+        )
+    else:
         print("Roles channel not found.")
+    role_queue.submit(member, add=added, remove=removed, on_applied=on_applied)
+    return True
+
+async def reconcile_promotions(guild, progress=None):
+    """Promote every member whose message count already passed a threshold.
+
+    Only members with enough messages are looked at, so this works without
+    the members intent. Returns (checked, promoted).
+    """
+    index = await get_promotion_index(guild)
+    await ensure_guild_data(guild.id, "activity_data")
+    candidates = [
+        (int(user_id), stats.get("messages", 0))
+        for user_id, stats in list(activity_data[guild.id].items())
+        if stats.get("messages", 0) >= index.min_threshold
+    ]
+    semaphore = asyncio.Semaphore(ROLE_QUEUE_CONCURRENCY)
+    checked = 0
+    promoted = 0
+
+    async def check(user_id, message_count):
+        nonlocal checked, promoted
+        member = guild.get_member(user_id)
+        if member is None:
+            async with semaphore:
+                try:
+                    member = await guild.fetch_member(user_id)
+                except discord.NotFound:
+                    member = None
+                except discord.HTTPException as e:
+                    print(f"Failed to fetch member {user_id}: {e}")
+                    member = None
+        if member and not role_queue.is_pending(member):
+            if queue_promotion(member, guild, index, [role.id for role in member.roles], message_count):
+                promoted += 1
+        checked += 1
+        if progress and (checked % 25 == 0 or checked == len(candidates)):
+            await progress(checked, len(candidates))
+
+    await asyncio.gather(*(check(user_id, count) for user_id, count in candidates))
+    return checked, promoted
+
+@bot.event
+async def on_guild_role_create(role):
+    promotion_indexes.pop(role.guild.id, None)
+
+@bot.event
+async def on_guild_role_update(before, after):
+    promotion_indexes.pop(after.guild.id, None)
+
+@bot.event
+async def on_guild_role_delete(role):
+    promotion_indexes.pop(role.guild.id, None)
+
+def get_promotion_ladder(guild):
+    """Return the guild's editable ladder, seeded from the default PROMOTIONS on first use."""
+    settings = promotion_settings[guild.id]
+    if "ladder" not in settings:
+        ladder = {}
+        for current_role_id, ladder_steps in build_promotion_index(guild).ladders.items():
+            thresholds, new_role_ids = ladder_steps
+            ladder[str(current_role_id)] = [
+                {"role": new_role_id, "threshold": threshold}
+                for threshold, new_role_id in zip(thresholds, new_role_ids)
+            ]
+        settings["ladder"] = ladder
+    return settings["ladder"]
+
+@bot.tree.command(name="setpromotion", description="Add or update an auto-promotion step (Admin only).")
+@app_commands.describe(current_role="Role members must have", new_role="Role they are promoted to", threshold="Messages needed")
+async def setpromotion_slash(interaction: discord.Interaction, current_role: discord.Role, new_role: discord.Role, threshold: int):
+    if not interaction.user.guild_permissions.administrator:
+        await interaction.response.send_message("You need to be an admin to use this command.", ephemeral=True)
+        return
+    if threshold < 1 or current_role == new_role:
+        await interaction.response.send_message("Invalid promotion step.", ephemeral=True)
+        return
+    guild_id = interaction.guild.id
+    await ensure_guild_data(guild_id, "promotion_settings")
+    ladder = get_promotion_ladder(interaction.guild)
+    steps = [step for step in ladder.get(str(current_role.id), []) if step["role"] != new_role.id]
+    steps.append({"role": new_role.id, "threshold": threshold})
+    ladder[str(current_role.id)] = sorted(steps, key=lambda step: step["threshold"])
+    await save_promotion_settings(guild_id, promotion_settings[guild_id], keys=["ladder"])
+    promotion_indexes.pop(guild_id, None)
+    await interaction.response.send_message(
+        f"Members with **{current_role.name}** will be promoted to **{new_role.name}** at {threshold} messages.", ephemeral=True
+    )
+
+@bot.tree.command(name="removepromotion", description="Remove auto-promotion steps for a role (Admin only).")
+@app_commands.describe(current_role="Role whose promotions to remove", new_role="Only remove the step to this role (optional)")
+async def removepromotion_slash(interaction: discord.Interaction, current_role: discord.Role, new_role: discord.Role = None):
+    if not interaction.user.guild_permissions.administrator:
+        await interaction.response.send_message("You need to be an admin to use this command.", ephemeral=True)
+        return
+    guild_id = interaction.guild.id
+    await ensure_guild_data(guild_id, "promotion_settings")
+    ladder = get_promotion_ladder(interaction.guild)
+    steps = [step for step in ladder.get(str(current_role.id), []) if new_role and step["role"] != new_role.id]
+    if steps:
+        ladder[str(current_role.id)] = steps
+    else:
+        ladder.pop(str(current_role.id), None)
+    await save_promotion_settings(guild_id, promotion_settings[guild_id], keys=["ladder"])
+    promotion_indexes.pop(guild_id, None)
+    await interaction.response.send_message(f"Promotion steps for **{current_role.name}** updated.", ephemeral=True)
+
+@bot.tree.command(name="promotionchannel", description="Set the channel for promotion announcements (Admin only).")
+@app_commands.describe(channel="The channel to announce promotions in")
+async def promotionchannel_slash(interaction: discord.Interaction, channel: discord.TextChannel):
+    if not interaction.user.guild_permissions.administrator:
+        await interaction.response.send_message("You need to be an admin to use this command.", ephemeral=True)
+        return
+    guild_id = interaction.guild.id
+    await ensure_guild_data(guild_id, "promotion_settings")
+    promotion_settings[guild_id]["channel_id"] = channel.id
+    await save_promotion_settings(guild_id, promotion_settings[guild_id], keys=["channel_id"])
+    promotion_indexes.pop(guild_id, None)
+    await interaction.response.send_message(f"Promotions will be announced in {channel.mention}.", ephemeral=True)
+
+@bot.tree.command(name="reconcileroles", description="Promote everyone who already earned a promotion (Admin only).")
+async def reconcileroles_slash(interaction: discord.Interaction):
+    if not interaction.user.guild_permissions.administrator:
+        await interaction.response.send_message("You need to be an admin to use this command.", ephemeral=True)
         return
+    await interaction.response.defer(ephemeral=True)
 
-    for current_role_name, (new_role_name, threshold) in PROMOTIONS.items():
-        current_role = discord.utils.get(guild.roles, name=current_role_name)
-        new_role = discord.utils.get(guild.roles, name=new_role_name)
+    async def progress(checked, total):
+        try:
+            await interaction.edit_original_response(content=f"⏳ Checked {checked}/{total} members...")
+        except discord.HTTPException:
+            pass
 
-        if current_role in member.roles and message_count >= threshold:
-            await member.remove_roles(current_role)
-            await member.add_roles(new_role)
-            await roles_channel.send(
-                f"🎉 Congratulations {member.mention}! You've been promoted to **{new_role_name}**!"
-            )
+    checked, promoted = await reconcile_promotions(interaction.guild, progress)
+    await interaction.edit_original_response(
+        content=f"✅ Checked {checked} members, queued {promoted} promotions."
+    )
+
+@bot.tree.command(name="promotions", description="List the server's auto-promotion steps.")
+async def promotions_slash(interaction: discord.Interaction):
+    index = await get_promotion_index(interaction.guild)
+    if not index.ladders:
+        await interaction.response.send_message("No auto-promotions are set up.", ephemeral=True)
+        return
+    response = "**Auto-promotions:**\n"
+    for current_role_id, (thresholds, new_role_ids) in index.ladders.items():
+        current_role = interaction.guild.get_role(current_role_id)
+        for threshold, new_role_id in zip(thresholds, new_role_ids):
+            response += f"- {current_role.mention} → {interaction.guild.get_role(new_role_id).mention} at {threshold} messages\n"
+    channel = interaction.guild.get_channel(index.channel_id)
+    response += f"Announcements: {channel.mention if channel else 'not set'}"
+    await interaction.response.send_message(response, ephemeral=True)
 
 @bot.tree.command(name="activity", description="View activity stats for a user.")
-@app_commands.describe(member="The user to view activity stats for (optional)")
-async def activity(interaction: discord.Interaction, member: discord.Member = None):
+@app_commands.describe(
+    member="The user to view activity stats for (optional)",
+    window="Only count messages from this time window (optional)",
+    channel="Only count messages in this channel (optional, defaults to the last 30 days)"
+)
+@app_commands.choices(window=[app_commands.Choice(name=name, value=name) for name in ACTIVITY_WINDOWS])
+async def activity(interaction: discord.Interaction, member: discord.Member = None, window: app_commands.Choice[str] = None, channel: discord.TextChannel = None):
     """View activity stats for a user."""
     guild_id = interaction.guild.id
-    ensure_guild_data(guild_id)
+    await ensure_guild_data(guild_id, "activity_data")
     member = member or interaction.user
     user_id = str(member.id)
     user_activity = activity_data[guild_id].get(user_id, {"messages": 0})
-    await interaction.response.send_message(f"{member.mention} has sent {user_activity['messages']} messages.")
+    if window is None and channel is None:
+        await interaction.response.send_message(f"{member.mention} has sent {user_activity['messages']} messages.")
+        return
+
+    hours, label = ACTIVITY_WINDOWS[window.value if window else "30d"]
+    buckets = await get_activity_buckets(guild_id)
+    per_channel = buckets.channel_counts(member.id, hours, time.time())
+    if channel:
+        await interaction.response.send_message(
+            f"{member.mention} has sent {per_channel.get(channel.id, 0)} messages in {channel.mention} in the last {label}."
+        )
+        return
+
+    response = f"{member.mention} has sent {sum(per_channel.values())} messages in the last {label}."
+    top_channels = sorted(per_channel.items(), key=lambda item: item[1], reverse=True)[:5]
+    for channel_id, count in top_channels:
+        channel_name = "other channels" if channel_id == OTHER_CHANNEL else f"<#{channel_id}>"
+        response += f"\n- {channel_name}: {count}"
+    await interaction.response.send_message(response)
+
+@bot.tree.command(name="activityleaderboard", description="View the server's message activity leaderboard.")
+@app_commands.describe(window="Only count messages from this time window (optional, default: all time)")
+@app_commands.choices(window=[app_commands.Choice(name=name, value=name) for name in ACTIVITY_WINDOWS])
+async def activityleaderboard_slash(interaction: discord.Interaction, window: app_commands.Choice[str] = None):
+    guild_id = interaction.guild.id
+    leaderboard = await get_activity_leaderboard(guild_id)
+    if window:
+        hours, label = ACTIVITY_WINDOWS[window.value]
+        ranking = leaderboard.ranking(hours, time.time())
+        title = f"🏆 **Activity Leaderboard** (last {label}) 💬\n\n"
+    else:
+        ranking = leaderboard.ranking()
+        title = "🏆 **Activity Leaderboard** 💬\n\n"
+
+    top_users = ranking.top(10)
+    if not top_users:
+        await interaction.response.send_message("No messages have been counted yet.")
+        return
+
+    leaderboard_text = title
+    for i, (user_id, count) in enumerate(top_users, 1):
+        if i == 1:
+            emoji = "🥇"
+        elif i == 2:
+            emoji = "🥈"
+        elif i == 3:
+            emoji = "🥉"
+        else:
+            emoji = f"**{i}.**"
+        leaderboard_text += f"{emoji} <@{user_id}> - {count} messages\n"
+
+    rank = ranking.rank(interaction.user.id)
+    if rank is not None:
+        leaderboard_text += f"\nYour rank: **#{rank}** of {len(ranking)} ({ranking.score(interaction.user.id)} messages)"
+    # Mentions are only used to show names, don't ping anyone
+    await interaction.response.send_message(leaderboard_text, allowed_mentions=discord.AllowedMentions.none())
+
+@bot.tree.command(name="botstats", description="View the bot's internal stats (Admin only).")
+async def botstats_slash(interaction: discord.Interaction):
+    if not interaction.user.guild_permissions.administrator:
+        await interaction.response.send_message("You need to be an admin to use this command.", ephemeral=True)
+        return
+    writer_stats = activity_writer.stats()
+    stats_text = "**Activity writer:**\n"
+    stats_text += f"- Backlog: {writer_stats['backlog_changes']} changes in {writer_stats['backlog_guilds']} guilds\n"
+    stats_text += f"- Flushes: {writer_stats['flushes']}\n"
+    stats_text += f"- Flush latency: {writer_stats['last_flush_ms']:.1f} ms (max {writer_stats['max_flush_ms']:.1f} ms)\n"
+    stats_text += f"- Hourly counters: {len(activity_buckets)} guilds loaded ({activity_buckets_bytes() / 1024:.1f}/{ACTIVITY_BUCKETS_MAX_BYTES / 1024:.1f} KiB), {activity_buckets_evictions} unloaded\n"
+    queue_stats = role_queue.stats()
+    stats_text += "**Role change queue:**\n"
+    stats_text += f"- Backlog: {queue_stats['backlog']} members, {announcements.backlog()} announcements\n"
+    stats_text += f"- Applied: {queue_stats['applied']} ({queue_stats['merged']} merged, {queue_stats['retries']} retries, {queue_stats['failed']} failed)\n"
+    cache_stats = guild_cache.stats()
+    stats_text += "**Guild data cache:**\n"
+    stats_text += f"- Entries: {cache_stats['entries']}/{guild_cache.max_entries} ({cache_stats['dirty']} dirty)\n"
+    if guild_cache.max_bytes:
+        stats_text += f"- Size: {cache_stats['bytes'] / 1024:.1f}/{guild_cache.max_bytes / 1024:.1f} KiB\n"
+    stats_text += f"- Hits/misses: {cache_stats['hits']}/{cache_stats['misses']} ({cache_stats['hit_rate'] * 100:.1f}% hit rate)\n"
+    stats_text += f"- Evictions: {cache_stats['evictions']}\n"
+    sweeper_stats = voice_sweeper.stats()
+    stats_text += "**Voice sweeper:**\n"
+    stats_text += f"- Sweeps: {sweeper_stats['sweeps']}\n"
+    stats_text += f"- Orphaned sessions closed: {sweeper_stats['closed']}, untracked members picked up: {sweeper_stats['opened']}\n"
+    stats_text += f"- Sessions archived: {sweeper_stats['archived']}\n"
+    stats_text += f"- Log backlog: {voice_logs.backlog()} summaries, {voice_logs.sent} messages and {voice_logs.attachments} files sent\n"
+    render_stats = routine_renders.stats()
+    stats_text += "**Routine render cache:**\n"
+    stats_text += f"- Entries: {render_stats['entries']} ({render_stats['bytes'] / 1024:.1f}/{routine_renders.max_bytes / 1024:.1f} KiB)\n"
+    stats_text += f"- Hits/misses: {render_stats['hits']} + {render_stats['disk_hits']} from disk/{render_stats['misses']} ({render_stats['hit_rate'] * 100:.1f}% hit rate)\n"
+    renderer_stats = routine_renderer.stats()
+    stats_text += "**Routine renderer:**\n"
+    stats_text += f"- Queue: {renderer_stats['in_flight']}/{routine_renderer.max_queue} on {renderer_stats['workers']} workers\n"
+    stats_text += f"- Renders: {renderer_stats['renders']} ({renderer_stats['rejected']} rejected, {renderer_stats['timeouts']} timed out, {renderer_stats['broken_pools']} crashed and {renderer_stats['hung_pools']} hung pools replaced)\n"
+    stats_text += f"- Render time: {renderer_stats['last_render_ms']:.1f} ms (max {renderer_stats['max_render_ms']:.1f} ms)\n"
+    trivia_stats = trivia_prefetcher.stats()
+    stats_text += "**Trivia prefetch:**\n"
+    stats_text += f"- Buffered: {trivia_stats['buffered']} questions ({trivia_stats['refilling']} refills running)\n"
+    stats_text += f"- Served from buffer: {trivia_stats['hits']}/{trivia_stats['hits'] + trivia_stats['misses']} ({trivia_stats['hit_rate'] * 100:.1f}% hit rate)\n"
+    stats_text += f"- Fetched: {trivia_stats['fetched']} ({trivia_stats['failed_refills']} failed refills, {trivia_stats['failed_fetches']} failed fetches)\n"
+    stats_text += f"- Question bank: {len(question_bank)} questions, {trivia_bank_served} served from it{' (offline mode)' if TRIVIA_OFFLINE else ''}\n"
+    stats_text += f"- Already seen questions skipped: {trivia_stats['skipped']}, session tokens requested: {trivia_token_stats['requested']}, reset: {trivia_token_stats['reset']}\n"
+    gateway_stats = trivia_gateway.stats()
+    stats_text += f"- Upstream requests: {gateway_stats['upstream_requests']} for {gateway_stats['callers']} fetches ({gateway_stats['coalesced']} coalesced, {gateway_stats['queued']} queued, {gateway_stats['rate_limit_wait']:.0f} s waited on the rate limit)\n"
+    http_stats = trivia_client.stats()
+    stats_text += f"- OpenTDB requests: {http_stats['requests']} ({http_stats['retries']} retries, {http_stats['rate_limited']} rate limited, {http_stats['failures']} failed)\n"
+    stats_text += f"- OpenTDB latency: {http_stats['avg_ms']:.0f} ms avg, {http_stats['p95_ms']:.0f} ms p95, {http_stats['max_ms']:.0f} ms max\n"
+    stats_text += "**Startup:**\n"
+    if startup_stats["ready_seconds"] is not None:
+        stats_text += f"- Time to ready: {startup_stats['ready_seconds']:.2f} s\n"
+    stats_text += f"- Command sync: {startup_stats['sync']}"
+    stats_text += f" ({startup_stats['sync_seconds']:.2f} s)\n" if startup_stats["sync_seconds"] else "\n"
+    await interaction.response.send_message(stats_text, ephemeral=True)
 
 class RPSButton(Button):
     def __init__(self, label, custom_id):
@@ -318,8 +1154,6 @@ class RPSButton(Button):
 
     async def callback(self, interaction: discord.Interaction):
         view: RPSView = self.view
-        if interaction.guild:
-            ensure_guild_data(interaction.guild.id)
         if interaction.user in view.choices:
             await interaction.response.send_message("You have already made your choice.", ephemeral=True)
             return
@@ -337,8 +1171,6 @@ class RPSView(View):
 
     async def handle_choice(self, interaction: discord.Interaction, choice: str):
         user = interaction.user
-        if interaction.guild:
-            ensure_guild_data(interaction.guild.id)
         if user not in [self.player1, self.player2] and self.player2 is not None:
             await interaction.response.send_message("You are not part of this game.", ephemeral=True)
             return
@@ -353,8 +1185,6 @@ class RPSView(View):
             await self.resolve_game(interaction)
 
     async def resolve_game(self, interaction: discord.Interaction):
-        if interaction.guild:
-            ensure_guild_data(interaction.guild.id)
         if self.player2:
             p1_choice = self.choices.get(self.player1)
             p2_choice = self.choices.get(self.player2)
@@ -383,8 +1213,6 @@ class RPSView(View):
 @app_commands.describe(opponent="The user you want to challenge (optional)")
 async def rps(interaction: discord.Interaction, opponent: discord.User = None):
     """Play Rock-Paper-Scissors (single or multi-player)"""
-    if interaction.guild:
-        ensure_guild_data(interaction.guild.id)
     if opponent and opponent == interaction.user:
         await interaction.response.send_message("You cannot challenge yourself.", ephemeral=True)
         return
@@ -404,8 +1232,6 @@ class FlipButton(Button):
 
     async def callback(self, interaction: discord.Interaction):
         view: FlipView = self.view
-        if interaction.guild:
-            ensure_guild_data(interaction.guild.id)
         # Prevent double choice
         if interaction.user in view.choices:
             await interaction.response.send_message("You have already made your choice.", ephemeral=True)
@@ -422,8 +1248,6 @@ class FlipView(View):
 
     async def handle_choice(self, interaction: discord.Interaction, choice: str):
         user = interaction.user
-        if interaction.guild:
-            ensure_guild_data(interaction.guild.id)
         if user not in [self.player1, self.player2]:
             await interaction.response.send_message("You are not part of this game.", ephemeral=True)
             return
@@ -462,9 +1286,6 @@ class FlipView(View):
 @bot.tree.command(name="flip", description="Play Heads or Tails (single or multi-player).")
 @app_commands.describe(opponent="The user you want to challenge (optional)")
 async def flip_slash(interaction: discord.Interaction, opponent: discord.User = None):
-    guild_id = interaction.guild.id if interaction.guild else None
-    if guild_id:
-        ensure_guild_data(guild_id)
     if opponent and opponent == interaction.user:
         await interaction.response.send_message("You cannot challenge yourself.", ephemeral=True)
         return
@@ -478,44 +1299,194 @@ async def flip_slash(interaction: discord.Interaction, opponent: discord.User =
         view = FlipView(player1=interaction.user)
         await interaction.response.send_message("Choose Heads or Tails:", view=view, ephemeral=True)
 
+class VoiceSweeper:
+    """Periodically reconciles open voice sessions and rotates old ones into the archive.
+
+    The first sweep after startup covers every guild so sessions left open
+    while the bot was down get closed; later sweeps only cover guilds whose
+    voice data is cached or that have someone in voice.
+    """
+
+    def __init__(self, interval=300.0):
+        self.interval = interval
+        self.sweeps = 0
+        self.closed = 0
+        self.opened = 0
+        self.archived = 0
+        self._task = None
+
+    async def sweep_guild(self, guild, now):
+        guild_id = guild.id
+        present = {
+            (channel.id, voice_member.id)
+            for channel in guild.voice_channels + guild.stage_channels
+            for voice_member in channel.members
+        }
+        if not present and guild_id not in voice_activity_data and self.sweeps:
+            return
+        await ensure_guild_data(guild_id, "voice_activity_data")
+        tracker = VoiceSessionTracker(voice_activity_data[guild_id])
+        closed, opened = tracker.sweep(present, now)
+        rotated = tracker.rotate(now, int(VOICE_LOG_MAX_AGE_DAYS * 86400), VOICE_LOG_MAX_SESSIONS)
+        # Evicting it while the archive is written must write it back first
+        guild_cache.mark_dirty("voice_activity_data", guild_id)
+        if rotated:
+            # Archive first, a crash in between leaves duplicates that /voicestats drops
+            await asyncio.to_thread(append_voice_archive, os.path.join(DATA_ROOT, str(guild_id)), rotated)
+        changed = ["open_sessions", "occupied_since", "swept_at", *tracker.changed_session_keys]
+        if closed:
+            changed += ["user_totals", "channel_totals"]
+        if tracker.dropped_legacy_log:
+            changed.append("voice_log")
+        await guild_cache.write_back("voice_activity_data", guild_id, keys=changed)
+        self.closed += closed
+        self.opened += opened
+        self.archived += len(rotated)
+
+    async def sweep(self):
+        now = int(time.time())
+        for guild in list(bot.guilds):
+            try:
+                await self.sweep_guild(guild, now)
+            except Exception as e:
+                print(f"Voice sweep failed for guild {guild.id}: {e}")
+        self.sweeps += 1
+
+    async def _run(self):
+        await bot.wait_until_ready()
+        while True:
+            await self.sweep()
+            await asyncio.sleep(self.interval)
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    def stats(self):
+        return {"sweeps": self.sweeps, "closed": self.closed, "opened": self.opened, "archived": self.archived}
+
+voice_sweeper = VoiceSweeper(interval=VOICE_SWEEP_INTERVAL)
+
 @bot.event
 async def on_voice_state_update(member, before, after):
     guild_id = member.guild.id
-    ensure_guild_data(guild_id)
-    vad = voice_activity_data[guild_id]
+    await ensure_guild_data(guild_id, "voice_activity_data")
+    tracker = VoiceSessionTracker(voice_activity_data[guild_id])
+    now = int(time.time())
 
     if before.channel is None and after.channel is not None:
-        if "voice_log" not in vad:
-            vad["voice_log"] = {}
-        if str(after.channel.id) not in vad["voice_log"]:
-            vad["voice_log"][str(after.channel.id)] = []
-        vad["voice_log"][str(after.channel.id)].append({
-            "user": member.name,
-            "action": "joined",
-            "timestamp": str(discord.utils.utcnow() + datetime.timedelta(hours=0, minutes=0))
-        })
+        tracker.join(after.channel.id, member.id, now)
+        changed = ["open_sessions", "occupied_since"]
     elif before.channel is not None and after.channel is None:
-        if "voice_log" not in vad:
-            vad["voice_log"] = {}
-        if str(before.channel.id) not in vad["voice_log"]:
-            vad["voice_log"][str(before.channel.id)] = []
-        vad["voice_log"][str(before.channel.id)].append({
-            "user": member.name,
-            "action": "left",
-            "timestamp": str(discord.utils.utcnow() + datetime.timedelta(hours=0, minutes=0))
-        })
-        
-        if before.channel.members == []:
-            log_channel = member.guild.get_channel(1308408556961136680)
-            if log_channel:
-                log_entries = vad["voice_log"].pop(str(before.channel.id), [])
-                log_message = f"Voice channel '{before.channel.name}' log:\n"
-                for entry in log_entries:
-                    timestamp = discord.utils.format_dt(discord.utils.parse_time(entry['timestamp']), style='t')
-                    log_message += f"{timestamp} - {entry['user']} {entry['action']} the channel.\n"
-                await log_channel.send(log_message)
-                
-    save_voice_activity_data(guild_id, vad)
+        tracker.leave(before.channel.id, member.id, now)
+        changed = ["open_sessions", "user_totals", "channel_totals"]
+    elif before.channel is not None and before.channel != after.channel:
+        tracker.move(before.channel.id, after.channel.id, member.id, now)
+        changed = ["open_sessions", "user_totals", "channel_totals", "occupied_since"]
+    else:
+        # Mute, deafen and other state changes within the same channel
+        return
+
+    if before.channel is not None and before.channel.members == []:
+        sessions = tracker.channel_emptied(before.channel.id)
+        if "occupied_since" not in changed:
+            changed.append("occupied_since")
+        log_channel = member.guild.get_channel(1308408556961136680)
+        if log_channel and sessions:
+            events = []
+            for _, member_id, start, end in sessions:
+                events.append((start, member_id, "joined"))
+                events.append((end, member_id, "left"))
+            log_message = f"Voice channel '{before.channel.name}' log ({format_duration(tracker.channel_total(before.channel.id))} in voice here all time):\n"
+            for timestamp, member_id, action in sorted(events):
+                voice_member = member.guild.get_member(member_id)
+                name = voice_member.name if voice_member else f"<@{member_id}>"
+                time_text = discord.utils.format_dt(datetime.datetime.fromtimestamp(timestamp, datetime.timezone.utc), style='t')
+                log_message += f"{time_text} - {name} {action} the channel.\n"
+            voice_logs.publish(log_channel, log_message)
+
+    # Only the day the session was filed under, not every session kept
+    changed += tracker.changed_session_keys
+    if tracker.dropped_legacy_log:
+        changed.append("voice_log")
+    await save_voice_activity_data(guild_id, voice_activity_data[guild_id], keys=changed)
+
+@bot.tree.command(name="voicestats", description="View voice channel stats for a date range.")
+@app_commands.describe(start="First day, YYYY-MM-DD (optional, default: 30 days ago)", end="Last day, YYYY-MM-DD (optional, default: today)")
+async def voicestats_slash(interaction: discord.Interaction, start: str = None, end: str = None):
+    guild_id = interaction.guild.id
+    local_tz = datetime.timezone(datetime.timedelta(minutes=UTC_OFFSET_MINUTES))
+    today = datetime.datetime.now(local_tz).date()
+    # Checked before deferring, followups can't be ephemeral after a public defer
+    try:
+        end_day = datetime.date.fromisoformat(end) if end else today
+        start_day = datetime.date.fromisoformat(start) if start else end_day - datetime.timedelta(days=29)
+    except ValueError:
+        await interaction.response.send_message("Invalid date. Please use YYYY-MM-DD.", ephemeral=True)
+        return
+    if start_day > end_day:
+        await interaction.response.send_message("The start date must be before the end date.", ephemeral=True)
+        return
+    await interaction.response.defer()
+    range_start = int(datetime.datetime.combine(start_day, datetime.time(), local_tz).timestamp())
+    range_end = int(datetime.datetime.combine(end_day + datetime.timedelta(days=1), datetime.time(), local_tz).timestamp())
+
+    await ensure_guild_data(guild_id, "voice_activity_data")
+    tracker = VoiceSessionTracker(voice_activity_data[guild_id])
+    now = int(time.time())
+    # Copy on the loop, the tracker keeps changing while the stats are computed in a thread
+    sessions = tracker.closed_sessions(range_start)
+    for key, session_start in tracker.open_sessions.items():
+        channel_id, member_id = key.split(":")
+        sessions.append([int(channel_id), int(member_id), session_start, now])
+    try:
+        archived = await asyncio.to_thread(load_voice_archive, os.path.join(DATA_ROOT, str(guild_id)), range_start, range_end)
+        if archived:
+            # A sweep interrupted between archiving and saving can leave a session in both
+            sessions = list({tuple(session): session for session in archived + sessions}.values())
+        stats = await asyncio.to_thread(compute_voice_stats, sessions, range_start, range_end, UTC_OFFSET_MINUTES * 60)
+    except Exception as e:
+        print(f"Failed to compute voice stats for guild {guild_id}: {e}")
+        await interaction.followup.send("Failed to compute voice stats, please try again.")
+        return
+    # Running totals survive archiving, so these cover every session ever closed
+    all_time_users = sorted(tracker.user_totals.items(), key=lambda item: item[1], reverse=True)[:5]
+    own_total = tracker.user_total(interaction.user.id)
+
+    if not stats["sessions"]:
+        await interaction.followup.send(f"No voice activity between {start_day} and {end_day}.")
+        return
+
+    stats_text = f"🎙️ **Voice Stats** ({start_day} → {end_day}) 🎙️\n\n"
+    stats_text += "**Time in voice:**\n"
+    top_users = sorted(stats["user_seconds"].items(), key=lambda item: item[1], reverse=True)[:10]
+    for i, (member_id, seconds) in enumerate(top_users, 1):
+        stats_text += f"{i}. <@{member_id}> - {format_duration(seconds)}\n"
+
+    stats_text += "\n**Peak users per channel:**\n"
+    for channel_id, peak in sorted(stats["channel_peaks"].items(), key=lambda item: item[1], reverse=True)[:5]:
+        stats_text += f"- <#{channel_id}>: {peak}\n"
+
+    busiest = sorted(range(24), key=lambda hour: stats["hour_seconds"][hour], reverse=True)[:3]
+    busiest_text = ", ".join(f"{hour:02d}:00 ({format_duration(stats['hour_seconds'][hour])})" for hour in busiest if stats["hour_seconds"][hour])
+    stats_text += f"\n**Busiest hours:** {busiest_text}\n"
+
+    if stats["pairs"]:
+        stats_text += "\n**Talked together the most:**\n"
+        for (member_a, member_b), seconds in sorted(stats["pairs"].items(), key=lambda item: item[1], reverse=True)[:5]:
+            stats_text += f"- <@{member_a}> & <@{member_b}> - {format_duration(seconds)}\n"
+
+    stats_text += "\n**All time:**\n"
+    for member_id, seconds in all_time_users:
+        stats_text += f"- <@{member_id}> - {format_duration(seconds)}\n"
+    stats_text += f"Your all-time voice time: {format_duration(own_total)}\n"
+
+    await interaction.followup.send(stats_text, allowed_mentions=discord.AllowedMentions.none())
 
 @bot.tree.command(name="announce", description="Announce a message to a channel (Admin only).")
 @app_commands.describe(message="The announcement message", channel="The channel to announce in (optional)")
@@ -534,148 +1505,62 @@ async def announce_slash(interaction: discord.Interaction, message: str, channel
     await interaction.response.send_message("Announcement sent!", ephemeral=True)
 
 
-def strip_ab_label(subject):
-    # Remove trailing ' (A)' or ' (B)' or '(A)' or '(B)' (with or without space)
-    return subject.rstrip().replace(' (A)', '').replace(' (B)', '').replace('(A)', '').replace('(B)', '').strip()
-
-def generate_routine_image(routine, filename="routine.png"):
-    days = ["Sunday", "Monday", "Tuesday", "Wednesday", "Thursday", "Friday"]
-    periods = [f"Period {i}" for i in range(1, 5)]
-    data = []
-    for day in days:
-        schedule = routine.get(day.lower(), "")
-        period_cells = []
-        for p in schedule.split(", "):
-            ab = [s.strip() for s in p.split("/") if s.strip()]
-            if len(ab) == 2:
-                a = strip_ab_label(ab[0])
-                b = strip_ab_label(ab[1])
-                period_cells.append(f"A: {a}\nB: {b}")
-            elif ab:
-                period_cells.append(ab[0])
-            else:
-                period_cells.append("")
-        while len(period_cells) < 4:
-            period_cells.append("")
-        data.append([day] + period_cells)
-
-    _, ax = plt.subplots(figsize=(11, 4))
-    ax.axis('off')
-    table = ax.table(
-        cellText=data,
-        colLabels=["Day"] + periods,
-        cellLoc='center',
-        loc='center',
-        colColours=["#2d415a"] + ["#4f6d7a"]*4
-    )
-    table.auto_set_font_size(False)
-    table.set_fontsize(12)
-    table.scale(1.2, 1.6)
-
-    # Style header
-    for (row, _), cell in table.get_celld().items():
-        if row == 0:
-            cell.set_fontsize(13)
-            cell.set_text_props(weight='bold', color='white')
-            cell.set_facecolor('#2d415a')
-        elif row % 2 == 1:
-            cell.set_facecolor('#f2f2f2')
-        else:
-            cell.set_facecolor('#e0e7ef')
-        cell.set_linewidth(1.5)
-        cell.set_edgecolor('#4f6d7a')
-        cell.set_height(0.15)
-
-    plt.title("Weekly Class Routine", fontsize=16, fontweight='bold', pad=20)
-    plt.tight_layout(pad=2.0)
-    plt.savefig(filename, bbox_inches='tight', dpi=200)
-    plt.close()
-
 @bot.tree.command(name="routine", description="Get the weekly routine as an image.")
 async def routine_slash(interaction: discord.Interaction):
     await interaction.response.defer()
-    filename = "routine.png"
     guild_id = interaction.guild.id if interaction.guild else None
     if guild_id:
-        ensure_guild_data(guild_id)
-        generate_routine_image(class_routine[guild_id], filename)
+        routine = await get_routine_model(guild_id)
     else:
-        generate_routine_image({}, filename)
-    if os.path.exists(filename):
-        with open(filename, "rb") as f:
-            await interaction.followup.send(file=discord.File(f, filename))
-    else:
-        await interaction.followup.send("Routine screenshot not found on the server.", ephemeral=True)
-
-def generate_routine_image_pdf(routine, filename="routine.pdf"):
-    days = ["Sunday", "Monday", "Tuesday", "Wednesday", "Thursday", "Friday"]
-    periods = [f"Period {i}" for i in range(1, 5)]
-    data = []
-    for day in days:
-        schedule = routine.get(day.lower(), "")
-        period_cells = []
-        for p in schedule.split(", "):
-            ab = [s.strip() for s in p.split("/") if s.strip()]
-            if len(ab) == 2:
-                a = strip_ab_label(ab[0])
-                b = strip_ab_label(ab[1])
-                period_cells.append(f"A: {a}\nB: {b}")
-            elif ab:
-                period_cells.append(ab[0])
-            else:
-                period_cells.append("")
-        while len(period_cells) < 4:
-            period_cells.append("")
-        data.append([day] + period_cells)
-
-    _, ax = plt.subplots(figsize=(14, 6))
-    ax.axis('off')
-    table = ax.table(
-        cellText=data,
-        colLabels=["Day"] + periods,
-        cellLoc='center',
-        loc='center',
-        colColours=["#2d415a"] + ["#4f6d7a"]*4,
-        bbox=[0, 0.08, 1, 0.80]
-    )
-    table.auto_set_font_size(False)
-    table.set_fontsize(15)
-    table.scale(1.5, 2.0)
-
-    for (row, _), cell in table.get_celld().items():
-        if row == 0:
-            cell.set_fontsize(16)
-            cell.set_text_props(weight='bold', color='white')
-            cell.set_facecolor('#2d415a')
-        elif row % 2 == 1:
-            cell.set_facecolor('#f2f2f2')
-        else:
-            cell.set_facecolor('#e0e7ef')
-        cell.set_linewidth(1.5)
-        cell.set_edgecolor('#4f6d7a')
-        cell.set_height(0.18)
+        routine = build_routine({})
+    await send_routine_file(interaction, routine, "png", "routine.png")
+
+routine_renders = RenderCache(max_bytes=ROUTINE_CACHE_MAX_BYTES, folder=ROUTINE_CACHE_DIR or None)
+routine_renderer = RoutineRenderer(
+    workers=ROUTINE_RENDER_WORKERS,
+    max_queue=ROUTINE_RENDER_QUEUE,
+    timeout=ROUTINE_RENDER_TIMEOUT
+)
 
-    plt.subplots_adjust(top=0.92)
-    plt.title("Weekly Class Routine", fontsize=22, fontweight='bold', pad=10)
-    plt.tight_layout(pad=1.0)
-    plt.savefig(filename, bbox_inches='tight', dpi=250, format='pdf')
-    plt.close()
+async def get_routine_render(routine, fmt):
+    """Rendered routine file as bytes, from the cache when the same routine was rendered before."""
+    return await render_routine_cached(routine_renders, routine_renderer, routine, fmt)
+
+async def send_routine_file(interaction, routine, fmt, filename):
+    try:
+        data = await get_routine_render(routine, fmt)
+    except RenderQueueFull:
+        await interaction.followup.send("Too many routines are being rendered right now, please try again in a moment.", ephemeral=True)
+        return
+    except asyncio.TimeoutError:
+        await interaction.followup.send("Rendering the routine took too long, please try again.", ephemeral=True)
+        return
+    except Exception as e:
+        # A crashed worker (BrokenProcessPool) or a failed render, the deferred interaction still needs an answer
+        print(f"Failed to render the routine as {fmt}: {e!r}")
+        await interaction.followup.send("Failed to render the routine, please try again.", ephemeral=True)
+        return
+    await interaction.followup.send(file=discord.File(io.BytesIO(data), filename))
+
+def prewarm_routine_renders(routine):
+    """Render a changed routine in the background so the next /routine or /routinepdf is a cache hit."""
+    async def prewarm():
+        for fmt in RENDER_STYLES:
+            try:
+                await get_routine_render(routine, fmt)
+            except Exception as e:
+                print(f"Failed to pre-render the routine as {fmt}: {e}")
+
+    bot.spawn(prewarm(), name="routine-prewarm")
 
 @bot.tree.command(name="routinepdf", description="Get the weekly routine as a styled PDF.")
 async def routinepdf_slash(interaction: discord.Interaction):
     await interaction.response.defer()
-    filename = "routine.pdf"
     if not interaction.guild:
         await interaction.followup.send("This command can only be used in a server.", ephemeral=True)
         return
     guild_id = interaction.guild.id
-    ensure_guild_data(guild_id)
-    generate_routine_image_pdf(class_routine[guild_id], filename)
-    if os.path.exists(filename):
-        with open(filename, "rb") as f:
-            await interaction.followup.send(file=discord.File(f, filename))
-    else:
-        await interaction.followup.send("Routine PDF not found on the server.", ephemeral=True)
+    await send_routine_file(interaction, await get_routine_model(guild_id), "pdf", "routine.pdf")
 
 class FileModal(Modal, title="Post a File"):
     def __init__(self, filename: str, guild_id: int = None):
@@ -724,10 +1609,16 @@ async def helpme_slash(interaction: discord.Interaction):
 - `/routinepdf`: Get the weekly routine as a styled PDF.
 
 **Activity Commands:**
-- `/activity [@user]`: View activity stats for a user.
+- `/activity [@user] [window] [#channel]`: View activity stats for a user, optionally for the last 24h/7d/30d or one channel.
+- `/activityleaderboard [window]`: View the server's message activity leaderboard.
+- `/promotions`: List the server's auto-promotion steps.
+- `/setpromotion <@current_role> <@new_role> <threshold>`: Add or update a promotion step (Admin only).
+- `/removepromotion <@current_role> [@new_role]`: Remove promotion steps (Admin only).
+- `/promotionchannel <#channel>`: Set where promotions are announced (Admin only).
+- `/reconcileroles`: Promote everyone who already earned a promotion (Admin only).
 
 **GK Quiz Commands:**
-- `/gk [count]`: Take GK quiz questions (1-20 questions, default: 1).
+- `/gk [count] [difficulty]`: Take GK quiz questions (1-20 questions, default: 1).
 - `/gkstats [@user]`: View GK quiz statistics.
 - `/gkleaderboard`: View the server's GK quiz leaderboard.
 
@@ -735,107 +1626,115 @@ async def helpme_slash(interaction: discord.Interaction):
 - `/rps [@opponent]`: Play Rock-Paper-Scissors (single or multi-player).
 - `/flip [@opponent]`: Play Heads or Tails (single or multi-player).
 
+**Voice Commands:**
+- `/voicestats [start] [end]`: View voice time, peak users, busiest hours, who talked together and all-time totals.
+
 **Other Commands:**
 - `/announce <#channel> <message>`: Announce a message to a channel (Admin only).
 - `/postfile <filename>`: Create a file with custom content.
+- `/botstats`: View the bot's internal stats (Admin only).
 - `/helpme`: Show this help message.
 """
     await interaction.response.send_message(help_text, ephemeral=True)
 
-async def fetch_trivia_question():
-    """Fetch a random trivia question from OpenTDB API"""
-    url = "https://opentdb.com/api.php?amount=1&category=9&type=multiple"
+trivia_client = OpenTDBClient(base_url=OPENTDB_URL, timeout=TRIVIA_HTTP_TIMEOUT, max_retries=TRIVIA_HTTP_RETRIES)
+question_bank = QuestionBank(TRIVIA_BANK_DIR)
+trivia_bank_served = 0
+trivia_token_stats = {"requested": 0, "reset": 0}
+
+async def get_trivia_token(guild_id, renew=False, wait_turn=None):
+    """The guild's OpenTDB session token, kept so OpenTDB doesn't send the guild a question twice"""
+    await ensure_guild_data(guild_id, "trivia_session")
+    session = trivia_session[guild_id]
+    if renew or "token" not in session:
+        if wait_turn:
+            await wait_turn()
+        session["token"] = await trivia_client.request_token()
+        trivia_token_stats["requested"] += 1
+        await save_trivia_session(guild_id, session, keys=["token"])
+    return session["token"]
+
+async def fetch_and_bank_questions(category, difficulty, amount, guild_id=None):
+    """Fetch questions from OpenTDB with the guild's session token and keep a copy in the local question bank"""
+    requests_made = 0
+
+    async def wait_turn():
+        # The gateway took a rate limit slot for the first OpenTDB request, later ones need their own
+        nonlocal requests_made
+        requests_made += 1
+        if requests_made > 1:
+            await trivia_gateway.bucket.acquire()
+
+    token = await get_trivia_token(guild_id, wait_turn=wait_turn) if guild_id else None
     try:
-        async with aiohttp.ClientSession() as session:
-            async with session.get(url) as response:
-                if response.status == 200:
-                    data = await response.json()
-                    if data['results']:
-                        question_data = data['results'][0]
-                        
-                        # Decode HTML entities
-                        question = html.unescape(question_data['question'])
-                        correct_answer = html.unescape(question_data['correct_answer'])
-                        incorrect_answers = [html.unescape(ans) for ans in question_data['incorrect_answers']]
-                        
-                        # Combine and shuffle answers
-                        all_answers = [correct_answer] + incorrect_answers
-                        random.shuffle(all_answers)
-                        
-                        # Find correct answer index
-                        correct_index = all_answers.index(correct_answer)
-                        
-                        return {
-                            'question': question,
-                            'answers': all_answers,
-                            'correct_index': correct_index,
-                            'category': html.unescape(question_data['category']),
-                            'difficulty': question_data['difficulty']
-                        }
-    except Exception as e:
-        print(f"Error fetching trivia question: {e}")
-    
-    # Fallback question if API fails
-    return {
-        'question': "What is the capital of France?",
-        'answers': ["Paris", "London", "Berlin", "Madrid"],
-        'correct_index': 0,
-        'category': "Geography",
-        'difficulty': "easy"
-    }
-
-async def fetch_multiple_trivia_questions(count):
-    """Fetch multiple random trivia questions from OpenTDB API"""
-    url = f"https://opentdb.com/api.php?amount={count}&category=9&type=multiple"
-    try:
-        async with aiohttp.ClientSession() as session:
-            async with session.get(url) as response:
-                if response.status == 200:
-                    data = await response.json()
-                    if data['results']:
-                        questions = []
-                        for question_data in data['results']:
-                            # Decode HTML entities
-                            question = html.unescape(question_data['question'])
-                            correct_answer = html.unescape(question_data['correct_answer'])
-                            incorrect_answers = [html.unescape(ans) for ans in question_data['incorrect_answers']]
-                            
-                            # Combine and shuffle answers
-                            all_answers = [correct_answer] + incorrect_answers
-                            random.shuffle(all_answers)
-                            
-                            # Find correct answer index
-                            correct_index = all_answers.index(correct_answer)
-                            
-                            questions.append({
-                                'question': question,
-                                'answers': all_answers,
-                                'correct_index': correct_index,
-                                'category': html.unescape(question_data['category']),
-                                'difficulty': question_data['difficulty']
-                            })
-                        return questions
-    except Exception as e:
-        print(f"Error fetching trivia questions: {e}")
-    
-    # Fallback questions if API fails
-    fallback_questions = [
-        {
-            'question': "What is the capital of France?",
-            'answers': ["Paris", "London", "Berlin", "Madrid"],
-            'correct_index': 0,
-            'category': "Geography",
-            'difficulty': "easy"
-        },
-        {
-            'question': "What is 2 + 2?",
-            'answers': ["3", "4", "5", "6"],
-            'correct_index': 1,
-            'category': "Mathematics",
-            'difficulty': "easy"
-        }
-    ]
-    return fallback_questions[:count]
+        await wait_turn()
+        questions = await trivia_client.fetch_questions(category, difficulty, amount, token)
+    except OpenTDBError as e:
+        if e.response_code == RESPONSE_TOKEN_NOT_FOUND:
+            # Tokens expire after 6 hours without use
+            token = await get_trivia_token(guild_id, renew=True, wait_turn=wait_turn)
+        elif e.response_code == RESPONSE_TOKEN_EMPTY:
+            # The guild has been sent every question for this query, start over
+            await wait_turn()
+            await trivia_client.reset_token(token)
+            trivia_token_stats["reset"] += 1
+        else:
+            raise
+        await wait_turn()
+        questions = await trivia_client.fetch_questions(category, difficulty, amount, token)
+    if questions:
+        await asyncio.to_thread(question_bank.add, category, questions)
+    return questions
+
+trivia_gateway = TriviaGateway(fetch_and_bank_questions, rate=1 / TRIVIA_REQUEST_INTERVAL)
+trivia_prefetcher = TriviaPrefetcher(trivia_gateway.fetch_questions, low_water=TRIVIA_LOW_WATER, batch_size=TRIVIA_BATCH_SIZE)
+
+def get_seen_filter(guild_id, user_id):
+    """The questions a user has been shown, see trivia.SeenFilter"""
+    return SeenFilter.from_dict(trivia_seen[guild_id].get(user_id))
+
+async def get_trivia_questions(count, difficulty=None, guild_id=None, user_id=None):
+    """Questions for a quiz from the prefetch buffer, topped up from the local question bank when OpenTDB falls short.
+    With a guild and user, questions the user has already been shown are skipped and the new ones are remembered."""
+    global trivia_bank_served
+    seen = SeenFilter()
+    if guild_id and user_id:
+        await ensure_guild_data(guild_id, "trivia_seen")
+        seen = get_seen_filter(guild_id, user_id)
+
+    def already_seen(question):
+        return question_hash(question['question']) in seen
+
+    questions = []
+
+    def pick(new_questions):
+        # Marked right away, so no later source repeats a question this quiz already has
+        for question in new_questions:
+            seen.add(question_hash(question['question']))
+        questions.extend(new_questions)
+
+    if not TRIVIA_OFFLINE:
+        pick(trivia_prefetcher.take_buffered(GENERAL_KNOWLEDGE, difficulty, count, scope=guild_id, exclude=already_seen))
+        if guild_id and len(questions) < count:
+            # The guild's buffer is still being filled, use the shared one warmed at startup
+            pick(trivia_prefetcher.take_buffered(GENERAL_KNOWLEDGE, difficulty, count - len(questions), exclude=already_seen))
+        if len(questions) < count:
+            pick(await trivia_prefetcher.take(
+                GENERAL_KNOWLEDGE, difficulty, count - len(questions), scope=guild_id, exclude=already_seen, timeout=TRIVIA_MAX_WAIT
+            ))
+    if len(questions) < count:
+        banked = await asyncio.to_thread(question_bank.sample, GENERAL_KNOWLEDGE, difficulty, count - len(questions), seen)
+        trivia_bank_served += len(banked)
+        pick(banked)
+    if not questions:
+        # Repeating a question beats having none
+        pick([question for question in FALLBACK_QUESTIONS if not already_seen(question)][:count] or FALLBACK_QUESTIONS[:count])
+    if guild_id and user_id:
+        # Fetching may have taken long enough for the filters to be evicted
+        await ensure_guild_data(guild_id, "trivia_seen")
+        trivia_seen[guild_id][user_id] = seen.to_dict()
+        await save_trivia_seen(guild_id, trivia_seen[guild_id], keys=[user_id])
+    return questions
 
 class MCQButton(Button):
     def __init__(self, label, custom_id, is_correct=False):
@@ -883,7 +1782,7 @@ class MCQView(View):
         
         if interaction.guild:
             guild_id = interaction.guild.id
-            ensure_guild_data(guild_id)
+            await ensure_guild_data(guild_id, "mcq_scores")
             
             user_id = str(self.player.id)
             if user_id not in mcq_scores[guild_id]:
@@ -893,7 +1792,7 @@ class MCQView(View):
             if is_correct:
                 mcq_scores[guild_id][user_id]["correct"] += 1
             
-            save_mcq_data(guild_id, mcq_scores[guild_id])
+            await save_mcq_data(guild_id, mcq_scores[guild_id], keys=[user_id])
         
         # Create response
         correct_answer = self.question_data["answers"][self.question_data["correct_index"]]
@@ -913,8 +1812,9 @@ class MCQView(View):
             item.disabled = True
 
 @bot.tree.command(name="gk", description="Take an GK quiz with trivia questions.")
-@app_commands.describe(count="Number of questions (1-20, default: 1)")
-async def gk_quiz(interaction: discord.Interaction, count: int = 1):
+@app_commands.describe(count="Number of questions (1-20, default: 1)", difficulty="Question difficulty (optional, default: any)")
+@app_commands.choices(difficulty=[app_commands.Choice(name=level.title(), value=level) for level in DIFFICULTIES])
+async def gk_quiz(interaction: discord.Interaction, count: int = 1, difficulty: app_commands.Choice[str] = None):
     """Start an GK quiz with trivia questions"""
     await interaction.response.defer(ephemeral=True)
     
@@ -924,12 +1824,11 @@ async def gk_quiz(interaction: discord.Interaction, count: int = 1):
         return
     
     guild_id = interaction.guild.id if interaction.guild else None
-    if guild_id:
-        ensure_guild_data(guild_id)
+    level = difficulty.value if difficulty else None
     
     if count == 1:
         # Single question mode (existing functionality)
-        question_data = await fetch_trivia_question()
+        question_data = (await get_trivia_questions(1, level, guild_id, str(interaction.user.id)))[0]
         
         question_text = f"🧠 **Trivia Question** 🧠\n\n"
         question_text += f"**Category:** {question_data['category']}\n"
@@ -941,7 +1840,7 @@ async def gk_quiz(interaction: discord.Interaction, count: int = 1):
         await interaction.followup.send(question_text, view=view, ephemeral=True)
     else:
         # Multiple questions mode
-        questions = await fetch_multiple_trivia_questions(count)
+        questions = await get_trivia_questions(count, level, guild_id, str(interaction.user.id))
         
         if not questions:
             await interaction.followup.send("❌ Failed to fetch questions. Please try again.", ephemeral=True)
@@ -949,7 +1848,7 @@ async def gk_quiz(interaction: discord.Interaction, count: int = 1):
         
         # Show first question
         first_q = questions[0]
-        question_text = f"🧠 **Multi-Question Quiz** (1/{count}) 🧠\n\n"
+        question_text = f"🧠 **Multi-Question Quiz** (1/{len(questions)}) 🧠\n\n"
         question_text += f"**Score:** 0/0\n"
         question_text += f"**Category:** {first_q['category']}\n"
         question_text += f"**Difficulty:** {first_q['difficulty'].title()}\n\n"
@@ -965,7 +1864,7 @@ async def gk_quiz(interaction: discord.Interaction, count: int = 1):
 async def gk_stats(interaction: discord.Interaction, member: discord.Member = None):
     """View GK quiz statistics for a user"""
     guild_id = interaction.guild.id
-    ensure_guild_data(guild_id)
+    await ensure_guild_data(guild_id, "mcq_scores")
     
     target_user = member or interaction.user
     user_id = str(target_user.id)
@@ -1006,7 +1905,7 @@ async def gk_stats(interaction: discord.Interaction, member: discord.Member = No
 async def gk_leaderboard(interaction: discord.Interaction):
     """View the server's GK quiz leaderboard"""
     guild_id = interaction.guild.id
-    ensure_guild_data(guild_id)
+    await ensure_guild_data(guild_id, "mcq_scores")
     
     if not mcq_scores[guild_id]:
         await interaction.response.send_message("No one has taken any GK quizzes yet! Use `/gk` to start.")
@@ -1156,7 +2055,7 @@ class MultiMCQView(View):
     async def finish_quiz(self, interaction: discord.Interaction, last_result):
         # Save final results
         if self.guild_id:
-            ensure_guild_data(self.guild_id)
+            await ensure_guild_data(self.guild_id, "mcq_scores")
             
             user_id = str(self.player.id)
             if user_id not in mcq_scores[self.guild_id]:
@@ -1165,7 +2064,7 @@ class MultiMCQView(View):
             mcq_scores[self.guild_id][user_id]["total"] += len(self.questions)
             mcq_scores[self.guild_id][user_id]["correct"] += self.correct_answers
             
-            save_mcq_data(self.guild_id, mcq_scores[self.guild_id])
+            await save_mcq_data(self.guild_id, mcq_scores[self.guild_id], keys=[user_id])
         
         # Final results
         accuracy = (self.correct_answers / len(self.questions)) * 100
@@ -1251,7 +2150,9 @@ class MultiMCQView(View):
             # If editing fails, we can't do much since we don't have an interaction context
             pass
 
-bot.run(os.getenv("DISCORD_BOT_TOKEN"))
+# Only the real entry point may start the bot, not scripts importing this file
+if __name__ == "__main__":
+    bot.run(os.getenv("DISCORD_BOT_TOKEN"))
 
 # Ensure the bot token is set in the environment variable DISCORD_BOT_TOKEN
 # You can set it in your terminal or in a .env file if you're using dotenv.
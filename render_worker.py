@@ -0,0 +1,19 @@
+"""Entry module for the routine render worker processes.
+
+Spawned workers import the parent's __main__ module before running anything,
+which for the bot would be all of app.py. RoutineRenderer starts them with this
+module standing in for __main__, so they only import routine.py.
+"""
+import os
+
+from routine import get_pyplot
+
+
+def init_worker():
+    # Pay for the matplotlib import and font cache once per worker, not per render
+    plt = get_pyplot()
+    plt.figure()
+    plt.close()
+
+def warm_up():
+    return os.getpid()
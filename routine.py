@@ -0,0 +1,467 @@
+import asyncio
+import hashlib
+import io
+import json
+import multiprocessing
+import os
+import sys
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+from storage import write_file_atomic
+
+
+DAYS = ["sunday", "monday", "tuesday", "wednesday", "thursday", "friday"]
+PERIODS_PER_DAY = 4
+GROUPS = ("A", "B")
+
+
+class RoutineError(ValueError):
+    pass
+
+
+def parse_entry(text):
+    """'Physics (A)' -> ['A', 'Physics'], 'Physics' -> [None, 'Physics']."""
+    text = text.strip()
+    for group in GROUPS:
+        if text.endswith(f"({group})"):
+            return [group, text[:-len(group) - 2].strip()]
+    return [None, text]
+
+def parse_schedule(schedule, strict=True):
+    """Parse a day like "Maths, Physics (A) / Chemistry (B), English" into periods.
+
+    Each period is a list of [group, subject] entries, group being "A", "B"
+    or None for the whole class. Two unlabelled subjects split by "/" are
+    taken as group A and group B. With `strict`, schedules that can't be
+    shown properly raise RoutineError; stored routines saved before they
+    were checked are parsed with strict=False instead.
+    """
+    periods = []
+    for number, period_text in enumerate(schedule.split(","), 1):
+        entries = [parse_entry(part) for part in period_text.split("/") if part.strip()]
+        if len(entries) == 2 and entries[0][0] is None and entries[1][0] is None:
+            entries = [["A", entries[0][1]], ["B", entries[1][1]]]
+        if strict:
+            groups = [group for group, _ in entries]
+            if len(entries) > 2:
+                raise RoutineError(f"Period {number} has more than two subjects, use 'Subject (A) / Subject (B)'.")
+            if len(entries) == 2 and (None in groups or groups[0] == groups[1]):
+                raise RoutineError(f"Period {number} needs one subject for group A and one for group B.")
+            if any(not subject for _, subject in entries):
+                raise RoutineError(f"Period {number} has a group label without a subject.")
+        periods.append(entries)
+    while periods and not periods[-1]:
+        periods.pop()
+    if strict and len(periods) > PERIODS_PER_DAY:
+        raise RoutineError(f"A day can have at most {PERIODS_PER_DAY} periods, got {len(periods)}.")
+    return periods
+
+def format_entry(entry):
+    group, subject = entry
+    return f"{subject} ({group})" if group else subject
+
+def format_schedule(periods):
+    """The stored form of a parsed day, parse_schedule(format_schedule(p)) == p."""
+    return ", ".join(" / ".join(format_entry(entry) for entry in period) for period in periods)
+
+def build_routine(stored_routine):
+    """Routine model, {day: periods} for every day in DAYS, from a guild's class_routine data."""
+    return {day: parse_schedule(stored_routine.get(day, ""), strict=False) for day in DAYS}
+
+
+def format_routine_table(day, periods):
+    table = f"**{day.capitalize()} Routine:**\n"
+    if not periods:
+        table += "No routine found.\n"
+    for idx, period in enumerate(periods, 1):
+        table += f"**Period {idx}:** {' / '.join(format_entry(entry) for entry in period)}\n"
+    return table
+
+def format_weekly_routine_table(routine):
+    lines = []
+    for day in DAYS:
+        periods = routine[day] + [[]] * (PERIODS_PER_DAY - len(routine[day]))
+        lines.append(f"{day.capitalize()}:")
+        for period_idx, period in enumerate(periods):
+            if period:
+                lines.append(f"  Period {period_idx+1}: {format_entry(period[0])}")
+                for entry in period[1:]:
+                    lines.append(f"      {format_entry(entry)}")
+            else:
+                lines.append(f"  Period {period_idx+1}: ")
+            if period_idx < len(periods) - 1:
+                lines.append("  --------")
+        lines.append("")
+    result = '```' + '\n'.join(lines).strip() + '```'
+    return result
+
+def routine_table_cells(routine):
+    """Rows of [day, period cells...] for the image and PDF tables."""
+    data = []
+    for day in DAYS:
+        cells = []
+        for period in routine[day][:PERIODS_PER_DAY]:
+            cells.append("\n".join(f"{group}: {subject}" if group else subject for group, subject in period))
+        cells += [""] * (PERIODS_PER_DAY - len(cells))
+        data.append([day.capitalize()] + cells)
+    return data
+
+
+def render_key(routine, fmt, style):
+    """Content hash of a routine and how it is rendered, equal routines share a key across guilds."""
+    payload = json.dumps([routine, fmt, style], sort_keys=True, separators=(",", ":"))
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class RenderCache:
+    """Rendered routine files (PNG/PDF bytes) keyed by render_key.
+
+    Entries live in an LRU bounded by `max_bytes`. With a `folder` they are
+    also written there as <key> files so renders survive restarts, and the
+    folder is kept to `max_bytes` too by removing the least recently used
+    files; the disk methods block and are meant to run in a worker thread.
+    Keys are content hashes and never go stale, so nothing is invalidated,
+    renders nobody asks for anymore just age out.
+    """
+
+    def __init__(self, max_bytes=16 * 1024 * 1024, folder=None):
+        self.max_bytes = max_bytes
+        self.folder = folder
+        self.entries = OrderedDict()
+        self.total_bytes = 0
+        # Renders running for a key, see render_routine_cached
+        self.pending = {}
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        data = self.entries.get(key)
+        if data is not None:
+            self.entries.move_to_end(key)
+        return data
+
+    def put(self, key, data):
+        self.discard(key)
+        if len(data) > self.max_bytes:
+            return
+        self.entries[key] = data
+        self.total_bytes += len(data)
+        while self.total_bytes > self.max_bytes:
+            _, evicted = self.entries.popitem(last=False)
+            self.total_bytes -= len(evicted)
+
+    def discard(self, key):
+        data = self.entries.pop(key, None)
+        if data is not None:
+            self.total_bytes -= len(data)
+
+    def load_from_disk(self, key):
+        if not self.folder:
+            return None
+        path = os.path.join(self.folder, key)
+        try:
+            with open(path, "rb") as file:
+                data = file.read()
+            # The modification time is the file's last use
+            os.utime(path)
+            return data
+        except FileNotFoundError:
+            return None
+
+    def save_to_disk(self, key, data):
+        if self.folder:
+            os.makedirs(self.folder, exist_ok=True)
+            write_file_atomic(os.path.join(self.folder, key), data)
+            self._prune_disk()
+
+    def _prune_disk(self):
+        files = []
+        for entry in os.scandir(self.folder):
+            # Skips write_file_atomic's hidden temporary files
+            if entry.is_file() and not entry.name.startswith("."):
+                stat = entry.stat()
+                files.append((stat.st_mtime, stat.st_size, entry.path))
+        total = sum(size for _, size, _ in files)
+        for _, size, path in sorted(files):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+
+    def stats(self):
+        lookups = self.hits + self.disk_hits + self.misses
+        return {
+            "entries": len(self.entries),
+            "bytes": self.total_bytes,
+            "hits": self.hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "hit_rate": (self.hits + self.disk_hits) / lookups if lookups else 0.0,
+        }
+
+
+def get_pyplot():
+    """Import matplotlib on first use, with the non-GUI Agg backend since we only ever save files."""
+    import matplotlib
+    matplotlib.use("Agg")
+    import matplotlib.pyplot as plt
+    return plt
+
+def generate_routine_image(routine, output, dpi=200):
+    """Draw the weekly routine table as a PNG into `output`, a binary file object such as BytesIO."""
+    plt = get_pyplot()
+    data = routine_table_cells(routine)
+    periods = [f"Period {i}" for i in range(1, PERIODS_PER_DAY + 1)]
+
+    _, ax = plt.subplots(figsize=(11, 4))
+    ax.axis('off')
+    table = ax.table(
+        cellText=data,
+        colLabels=["Day"] + periods,
+        cellLoc='center',
+        loc='center',
+        colColours=["#2d415a"] + ["#4f6d7a"]*PERIODS_PER_DAY
+    )
+    table.auto_set_font_size(False)
+    table.set_fontsize(12)
+    table.scale(1.2, 1.6)
+
+    # Style header
+    for (row, _), cell in table.get_celld().items():
+        if row == 0:
+            cell.set_fontsize(13)
+            cell.set_text_props(weight='bold', color='white')
+            cell.set_facecolor('#2d415a')
+        elif row % 2 == 1:
+            cell.set_facecolor('#f2f2f2')
+        else:
+            cell.set_facecolor('#e0e7ef')
+        cell.set_linewidth(1.5)
+        cell.set_edgecolor('#4f6d7a')
+        cell.set_height(0.15)
+
+    plt.title("Weekly Class Routine", fontsize=16, fontweight='bold', pad=20)
+    plt.tight_layout(pad=2.0)
+    plt.savefig(output, bbox_inches='tight', dpi=dpi, format='png')
+    plt.close()
+
+def generate_routine_image_pdf(routine, output, dpi=250):
+    """Draw the weekly routine table as a styled PDF into `output`."""
+    plt = get_pyplot()
+    data = routine_table_cells(routine)
+    periods = [f"Period {i}" for i in range(1, PERIODS_PER_DAY + 1)]
+
+    _, ax = plt.subplots(figsize=(14, 6))
+    ax.axis('off')
+    table = ax.table(
+        cellText=data,
+        colLabels=["Day"] + periods,
+        cellLoc='center',
+        loc='center',
+        colColours=["#2d415a"] + ["#4f6d7a"]*PERIODS_PER_DAY,
+        bbox=[0, 0.08, 1, 0.80]
+    )
+    table.auto_set_font_size(False)
+    table.set_fontsize(15)
+    table.scale(1.5, 2.0)
+
+    for (row, _), cell in table.get_celld().items():
+        if row == 0:
+            cell.set_fontsize(16)
+            cell.set_text_props(weight='bold', color='white')
+            cell.set_facecolor('#2d415a')
+        elif row % 2 == 1:
+            cell.set_facecolor('#f2f2f2')
+        else:
+            cell.set_facecolor('#e0e7ef')
+        cell.set_linewidth(1.5)
+        cell.set_edgecolor('#4f6d7a')
+        cell.set_height(0.18)
+
+    plt.subplots_adjust(top=0.92)
+    plt.title("Weekly Class Routine", fontsize=22, fontweight='bold', pad=10)
+    plt.tight_layout(pad=1.0)
+    # No creation date, so the same routine always renders to the same bytes
+    plt.savefig(output, bbox_inches='tight', dpi=dpi, format='pdf', metadata={'CreationDate': None})
+    plt.close()
+
+# Part of the render cache key, change it when the look of a rendered routine changes
+RENDER_STYLES = {"png": "table-v2-11x4-dpi200", "pdf": "table-v2-14x6-dpi250"}
+RENDERERS = {"png": generate_routine_image, "pdf": generate_routine_image_pdf}
+
+def render_routine_bytes(routine, fmt):
+    buffer = io.BytesIO()
+    RENDERERS[fmt](routine, buffer)
+    return buffer.getvalue()
+
+
+class RenderQueueFull(Exception):
+    pass
+
+
+@contextmanager
+def _render_worker_main():
+    """Have workers spawned in this block import render_worker instead of the parent's __main__."""
+    import render_worker
+    main = sys.modules["__main__"]
+    sys.modules["__main__"] = render_worker
+    try:
+        yield render_worker
+    finally:
+        sys.modules["__main__"] = main
+
+
+class RoutineRenderer:
+    """Renders routines in a pool of worker processes so matplotlib never blocks the event loop.
+
+    Workers are spawned fresh rather than forked from the bot, load only
+    render_worker and routine, and get plain routine dicts in and file bytes
+    out. At most `max_queue` renders may be waiting or running, further ones
+    raise RenderQueueFull, and a render that takes longer than `timeout`
+    seconds raises asyncio.TimeoutError. A timed out render still holds its
+    place in the queue until its worker is done with it, and once every
+    worker is stuck on one the pool is replaced.
+    """
+
+    def __init__(self, workers=2, max_queue=8, timeout=30.0):
+        self.workers = workers
+        self.max_queue = max_queue
+        self.timeout = timeout
+        self.pool = None
+        self.in_flight = 0
+        # Timed out renders still running on the current pool
+        self.overdue = set()
+        self.renders = 0
+        self.rejected = 0
+        self.timeouts = 0
+        self.broken_pools = 0
+        self.hung_pools = 0
+        self.last_render_ms = 0.0
+        self.max_render_ms = 0.0
+
+    def start(self):
+        if self.pool is None:
+            with _render_worker_main() as render_worker:
+                self.pool = ProcessPoolExecutor(
+                    max_workers=self.workers,
+                    mp_context=multiprocessing.get_context("spawn"),
+                    initializer=render_worker.init_worker
+                )
+                # Start every worker now instead of on the first /routine
+                for _ in range(self.workers):
+                    self.pool.submit(render_worker.warm_up)
+
+    def _replace_pool(self, pool):
+        if self.pool is pool:
+            self.pool = None
+            self.overdue.clear()
+            pool.shutdown(wait=False, cancel_futures=True)
+
+    def _broken(self, pool):
+        # A worker died, every render on this pool now fails; start a fresh one next time
+        if self.pool is pool:
+            self.broken_pools += 1
+            self._replace_pool(pool)
+
+    def _finished(self, future):
+        self.in_flight -= 1
+        self.overdue.discard(future)
+
+    async def render(self, routine, fmt):
+        if self.in_flight >= self.max_queue:
+            self.rejected += 1
+            raise RenderQueueFull(f"{self.in_flight} routine renders already queued")
+        self.start()
+        loop = asyncio.get_running_loop()
+        started = time.perf_counter()
+        pool = self.pool
+        try:
+            future = pool.submit(render_routine_bytes, routine, fmt)
+        except BrokenProcessPool:
+            self._broken(pool)
+            raise
+        self.in_flight += 1
+
+        def finished(future):
+            # The queue slot is given back once the worker is done, not when we stop waiting
+            try:
+                loop.call_soon_threadsafe(self._finished, future)
+            except RuntimeError:
+                # The loop is already closed
+                pass
+
+        future.add_done_callback(finished)
+        try:
+            data = await asyncio.wait_for(asyncio.wrap_future(future), self.timeout)
+        except asyncio.TimeoutError:
+            self.timeouts += 1
+            if not future.done() and self.pool is pool:
+                self.overdue.add(future)
+                if len(self.overdue) >= self.workers:
+                    # Every worker is busy with a render nobody is waiting for, new ones get fresh workers
+                    self.hung_pools += 1
+                    self._replace_pool(pool)
+            raise
+        except BrokenProcessPool:
+            self._broken(pool)
+            raise
+        self.renders += 1
+        self.last_render_ms = (time.perf_counter() - started) * 1000
+        self.max_render_ms = max(self.max_render_ms, self.last_render_ms)
+        return data
+
+    async def stop(self):
+        if self.pool is not None:
+            pool, self.pool = self.pool, None
+            await asyncio.to_thread(pool.shutdown, wait=True, cancel_futures=True)
+
+    def stats(self):
+        return {
+            "workers": self.workers,
+            "in_flight": self.in_flight,
+            "renders": self.renders,
+            "rejected": self.rejected,
+            "timeouts": self.timeouts,
+            "broken_pools": self.broken_pools,
+            "hung_pools": self.hung_pools,
+            "last_render_ms": self.last_render_ms,
+            "max_render_ms": self.max_render_ms,
+        }
+
+
+async def render_routine_cached(cache, renderer, routine, fmt):
+    """Rendered routine file as bytes from `cache` (memory, then disk), rendering it with `renderer` on a miss.
+
+    Requests for a routine that is already being rendered wait for that render.
+    """
+    key = render_key(routine, fmt, RENDER_STYLES[fmt])
+    data = cache.get(key)
+    if data is not None:
+        cache.hits += 1
+        return data
+    task = cache.pending.get(key)
+    if task is None:
+        task = cache.pending[key] = asyncio.create_task(_load_or_render(cache, renderer, key, routine, fmt))
+        task.add_done_callback(lambda _: cache.pending.pop(key, None))
+    else:
+        cache.hits += 1
+    return await asyncio.shield(task)
+
+async def _load_or_render(cache, renderer, key, routine, fmt):
+    data = await asyncio.to_thread(cache.load_from_disk, key)
+    if data is not None:
+        cache.disk_hits += 1
+    else:
+        cache.misses += 1
+        data = await renderer.render(routine, fmt)
+        await asyncio.to_thread(cache.save_to_disk, key, data)
+    cache.put(key, data)
+    return data
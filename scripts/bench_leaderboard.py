@@ -0,0 +1,90 @@
+"""Compare the incremental activity leaderboard with sorting every member per request.
+
+Builds a synthetic guild, then measures per-message update cost, top-10
+queries and "what rank am I" queries for both approaches.
+
+Usage: python scripts/bench_leaderboard.py [--members 100000] [--queries 200] [--updates 100000]
+"""
+import argparse
+import json
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from activity import RankIndex
+
+
+def sort_top(counts, k):
+    return sorted(counts.items(), key=lambda item: (-item[1], item[0]))[:k]
+
+def sort_rank(counts, user_id):
+    ordered = sorted(counts.values(), reverse=True)
+    return ordered.index(counts[user_id]) + 1
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--members", type=int, default=100000)
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--updates", type=int, default=100000)
+    parser.add_argument("--json", action="store_true", help="print results as JSON")
+    args = parser.parse_args()
+
+    random.seed(1)
+    # Long-tailed message counts like a real server
+    counts = {user_id: int(random.paretovariate(1.2) * 10) for user_id in range(args.members)}
+    users = list(counts)
+
+    start = time.perf_counter()
+    index = RankIndex()
+    for user_id, count in counts.items():
+        index.add(user_id, count)
+    build = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for _ in range(args.updates):
+        user_id = random.choice(users)
+        counts[user_id] += 1
+        index.add(user_id, 1)
+    update = (time.perf_counter() - start) / args.updates
+
+    assert index.top(10) == sort_top(counts, 10)
+
+    sample = [random.choice(users) for _ in range(args.queries)]
+    timings = {}
+    for name, top, rank in (
+        ("incremental", lambda: index.top(10), index.rank),
+        ("sort-everything", lambda: sort_top(counts, 10), lambda user_id: sort_rank(counts, user_id)),
+    ):
+        start = time.perf_counter()
+        for _ in range(args.queries):
+            top()
+        top_time = (time.perf_counter() - start) / args.queries
+        start = time.perf_counter()
+        for user_id in sample:
+            rank(user_id)
+        rank_time = (time.perf_counter() - start) / args.queries
+        timings[name] = {"top10_ms": round(top_time * 1000, 4), "rank_ms": round(rank_time * 1000, 4)}
+
+    for user_id in sample[:20]:
+        assert index.rank(user_id) == sort_rank(counts, user_id)
+
+    results = {
+        "members": args.members,
+        "build_ms": round(build * 1000, 2),
+        "update_us": round(update * 1e6, 3),
+        "queries": timings,
+    }
+    if args.json:
+        print(json.dumps(results, indent=4))
+        return
+    print(f"{args.members} members, index built in {results['build_ms']} ms, {results['update_us']} us per message")
+    for name, timing in timings.items():
+        print(f"{name:>16}: top-10 {timing['top10_ms']:>10.4f} ms   rank {timing['rank_ms']:>10.4f} ms")
+
+
+if __name__ == "__main__":
+    main()
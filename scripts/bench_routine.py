@@ -0,0 +1,109 @@
+"""Measure what rendering the routine costs as text, PNG and PDF.
+
+Each image/PDF case runs in a fresh process so its peak RSS is its own. The
+first render in a process (font cache, figure setup) is reported apart from
+the median of the renders after it.
+
+Usage: python scripts/bench_routine.py [--repeats 5] [--dpi 100 200 250] [--json]
+"""
+import argparse
+import io
+import json
+import multiprocessing
+import os
+import resource
+import statistics
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from routine import DAYS, RENDERERS, build_routine, format_routine_table, format_weekly_routine_table
+
+
+def sample_routines():
+    realistic = {
+        "sunday": "Maths, Physics (A) / Chemistry (B), English, Nepali",
+        "monday": "Computer, Biology, Social, Maths",
+        "tuesday": "Physics, Chemistry, English (A) / Computer (B), Maths",
+        "wednesday": "Nepali, Maths, Physics, Chemistry",
+        "thursday": "English, Computer (A) / Biology (B), Social",
+        "friday": "Maths, Physics",
+    }
+    long_name = "Applied Mathematics and Numerical Methods Laboratory"
+    worst = {
+        day: ", ".join(f"{long_name} {day} {i} (A) / {long_name} {day} {i} (B)" for i in range(1, 5))
+        for day in DAYS
+    }
+    return {"realistic": build_routine(realistic), "worst-case": build_routine(worst)}
+
+
+def peak_rss_kib():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in KiB on Linux and in bytes on macOS
+    return peak // 1024 if sys.platform == "darwin" else peak
+
+def render_case(routine, fmt, dpi, repeats):
+    timings = []
+    size = 0
+    for _ in range(repeats + 1):
+        buffer = io.BytesIO()
+        start = time.perf_counter()
+        RENDERERS[fmt](routine, buffer, dpi=dpi)
+        timings.append(time.perf_counter() - start)
+        size = len(buffer.getvalue())
+    return {
+        "first_ms": round(timings[0] * 1000, 2),
+        "median_ms": round(statistics.median(timings[1:]) * 1000, 2),
+        "bytes": size,
+        "peak_rss_kib": peak_rss_kib(),
+    }
+
+def bench_text(routine, repeats):
+    repeats *= 100
+    start = time.perf_counter()
+    for _ in range(repeats):
+        format_weekly_routine_table(routine)
+    week = (time.perf_counter() - start) / repeats
+    start = time.perf_counter()
+    for _ in range(repeats):
+        for day in DAYS:
+            format_routine_table(day, routine[day])
+    days = (time.perf_counter() - start) / repeats / len(DAYS)
+    return {"week_us": round(week * 1e6, 2), "day_us": round(days * 1e6, 2), "bytes": len(format_weekly_routine_table(routine))}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--repeats", type=int, default=5, help="renders timed per case after the first")
+    parser.add_argument("--dpi", type=int, nargs="+", default=[100, 200, 250])
+    parser.add_argument("--formats", nargs="+", default=list(RENDERERS), choices=list(RENDERERS))
+    parser.add_argument("--json", action="store_true", help="print results as JSON")
+    args = parser.parse_args()
+
+    results = []
+    context = multiprocessing.get_context("spawn")
+    for name, routine in sample_routines().items():
+        results.append({"routine": name, "format": "text", "dpi": None, **bench_text(routine, args.repeats)})
+        for fmt in args.formats:
+            for dpi in args.dpi:
+                with ProcessPoolExecutor(max_workers=1, mp_context=context) as pool:
+                    case = pool.submit(render_case, routine, fmt, dpi, args.repeats).result()
+                results.append({"routine": name, "format": fmt, "dpi": dpi, **case})
+
+    if args.json:
+        print(json.dumps(results, indent=4))
+        return
+    for result in results:
+        if result["format"] == "text":
+            print(f"{result['routine']:>10} text        week {result['week_us']:>8.2f} us   day {result['day_us']:>8.2f} us   {result['bytes']:>8} B")
+        else:
+            print(
+                f"{result['routine']:>10} {result['format']} @{result['dpi']:<4}  first {result['first_ms']:>8.1f} ms   "
+                f"median {result['median_ms']:>8.1f} ms   {result['bytes']:>8} B   peak RSS {result['peak_rss_kib'] / 1024:>6.1f} MiB"
+            )
+
+
+if __name__ == "__main__":
+    main()
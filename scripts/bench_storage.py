@@ -0,0 +1,83 @@
+"""Compare the JSON, journal and SQLite storage backends on a message-rate workload.
+
+Each simulated message bumps one member's counter. "write-through" saves after
+every message (the old on_message behaviour), "write-behind" saves the changed
+members once per batch like the activity writer does.
+
+Usage: python scripts/bench_storage.py [--members 2000] [--messages 5000] [--batch 500]
+"""
+import argparse
+import json
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from storage import JournalBackend, JsonBackend, SqliteBackend
+
+
+def run_workload(backend, members, messages, batch):
+    guild_id = "1"
+    data = {str(user_id): {"messages": random.randint(0, 1000)} for user_id in range(members)}
+    backend.save(guild_id, "activity_data", data)
+    dirty = set()
+    start = time.perf_counter()
+    for i in range(messages):
+        user_id = str(random.randrange(members))
+        data[user_id]["messages"] += 1
+        dirty.add(user_id)
+        if (i + 1) % batch == 0:
+            backend.save(guild_id, "activity_data", data, dirty)
+            dirty = set()
+    if dirty:
+        backend.save(guild_id, "activity_data", data, dirty)
+    elapsed = time.perf_counter() - start
+    assert backend.load(guild_id, "activity_data") == data
+    return elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--members", type=int, default=2000)
+    parser.add_argument("--messages", type=int, default=5000)
+    parser.add_argument("--batch", type=int, default=500, help="messages per write-behind flush")
+    parser.add_argument("--json", action="store_true", help="print results as JSON")
+    args = parser.parse_args()
+
+    results = []
+    for mode, batch in (("write-through", 1), ("write-behind", args.batch)):
+        for name in ("json", "journal", "sqlite"):
+            root = tempfile.mkdtemp()
+            try:
+                if name == "json":
+                    backend = JsonBackend(root)
+                elif name == "journal":
+                    backend = JournalBackend(root)
+                else:
+                    backend = SqliteBackend(os.path.join(root, "bench.sqlite3"))
+                elapsed = run_workload(backend, args.members, args.messages, batch)
+                backend.close()
+            finally:
+                shutil.rmtree(root)
+            results.append({
+                "backend": name,
+                "mode": mode,
+                "members": args.members,
+                "messages": args.messages,
+                "seconds": round(elapsed, 4),
+                "messages_per_second": round(args.messages / elapsed, 1),
+            })
+
+    if args.json:
+        print(json.dumps(results, indent=4))
+        return
+    for result in results:
+        print(f"{result['backend']:>7} {result['mode']:<13} {result['seconds']:>8.3f}s  {result['messages_per_second']:>10.1f} msg/s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,88 @@
+"""Fire many simultaneous routine renders for different guilds and check each gets its own routine.
+
+Every guild gets a routine with a unique subject. Each render is compared
+with a render of the same routine done alone in this process, so output
+that leaked between requests, or got mixed up in the cache, is caught.
+Requests go through the bot's cached render path, so each routine and
+format must be rendered exactly once however many times it is asked for.
+
+Usage: python scripts/check_routine_renders.py [--guilds 24] [--rounds 2] [--workers 2]
+"""
+import argparse
+import asyncio
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from routine import RENDER_STYLES, RenderCache, RoutineRenderer, build_routine, render_routine_bytes, render_routine_cached
+
+
+def guild_routine(guild_id):
+    return build_routine({
+        "sunday": f"Guild {guild_id} Maths, Physics (A) / Chemistry (B), English, Nepali",
+        "monday": f"Computer, Guild {guild_id} Biology, Social, Maths",
+        "tuesday": "Physics, Chemistry, English (A) / Computer (B), Maths",
+    })
+
+
+async def render_all(renderer, cache, routines, rounds):
+    async def render(guild_id, fmt):
+        # The bot's own path, so simultaneous requests for a routine share one render
+        data = await render_routine_cached(cache, renderer, routines[guild_id], fmt)
+        return guild_id, fmt, data
+
+    jobs = [render(guild_id, fmt) for _ in range(rounds) for guild_id in routines for fmt in RENDER_STYLES]
+    return await asyncio.gather(*jobs)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--guilds", type=int, default=24)
+    parser.add_argument("--rounds", type=int, default=2, help="times every guild asks for each format")
+    parser.add_argument("--workers", type=int, default=2)
+    parser.add_argument("--json", action="store_true", help="print results as JSON")
+    args = parser.parse_args()
+
+    routines = {guild_id: guild_routine(guild_id) for guild_id in range(args.guilds)}
+    expected = {
+        (guild_id, fmt): render_routine_bytes(routine, fmt)
+        for guild_id, routine in routines.items()
+        for fmt in RENDER_STYLES
+    }
+
+    async def run():
+        renderer = RoutineRenderer(workers=args.workers, max_queue=args.guilds * args.rounds * len(RENDER_STYLES))
+        renderer.start()
+        try:
+            start = time.perf_counter()
+            results = await render_all(renderer, RenderCache(), routines, args.rounds)
+            return results, time.perf_counter() - start, renderer.stats()
+        finally:
+            await renderer.stop()
+
+    results, elapsed, stats = asyncio.run(run())
+    mismatches = [[guild_id, fmt] for guild_id, fmt, data in results if data != expected[(guild_id, fmt)]]
+
+    unique = len(routines) * len(RENDER_STYLES)
+    summary = {
+        "requests": len(results),
+        "renders": stats["renders"],
+        "expected_renders": unique,
+        "mismatches": mismatches,
+        "elapsed_s": round(elapsed, 2),
+    }
+    if args.json:
+        print(json.dumps(summary, indent=4))
+    else:
+        print(f"{summary['requests']} requests, {summary['renders']} renders in {summary['elapsed_s']} s")
+        print("OK, every guild got its own routine" if not mismatches else f"MISMATCHED: {mismatches}")
+        if stats["renders"] != unique:
+            print(f"Expected {unique} renders, one per routine and format")
+    sys.exit(1 if mismatches or stats["renders"] != unique else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,39 @@
+"""Import trivia question packs into the local question bank used when OpenTDB is unreachable.
+
+A pack is a JSON file holding either an OpenTDB API response ({"results": [...]})
+or a plain list of OpenTDB style results. Questions already in the bank are
+skipped.
+
+Usage: python scripts/import_trivia_pack.py pack.json [more.json ...] [--category 9] [--bank guild_data/trivia_bank]
+"""
+import argparse
+import json
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from trivia import DIFFICULTIES, GENERAL_KNOWLEDGE, QuestionBank, decode_question
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("packs", nargs="+")
+    parser.add_argument("--category", type=int, default=GENERAL_KNOWLEDGE, help="OpenTDB category id the questions belong to")
+    parser.add_argument("--bank", default=os.path.join("guild_data", "trivia_bank"))
+    args = parser.parse_args()
+
+    bank = QuestionBank(args.bank)
+    for path in args.packs:
+        with open(path, "r", encoding="utf-8") as file:
+            pack = json.load(file)
+        results = pack["results"] if isinstance(pack, dict) else pack
+        questions = [decode_question(result) for result in results if result.get("type", "multiple") == "multiple"]
+        added = bank.add(args.category, questions)
+        print(f"{path}: {added} new of {len(questions)} questions")
+    counts = ", ".join(f"{level} {bank.count(args.category, level)}" for level in DIFFICULTIES)
+    print(f"Bank now has {len(bank)} questions ({counts} in category {args.category})")
+
+
+if __name__ == "__main__":
+    main()
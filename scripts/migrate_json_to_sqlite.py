@@ -0,0 +1,45 @@
+"""Import an existing guild_data/<guild_id>/*.json tree into the SQLite backend.
+
+Usage: python scripts/migrate_json_to_sqlite.py [--root guild_data] [--db guild_data/guild_data.sqlite3]
+"""
+import argparse
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from storage import DATASET_FILES, JsonBackend, SqliteBackend
+
+
+def migrate(root, db_path):
+    source = JsonBackend(root)
+    target = SqliteBackend(db_path)
+    migrated = 0
+    try:
+        for guild_id in sorted(os.listdir(root)):
+            if not os.path.isdir(os.path.join(root, guild_id)):
+                continue
+            for dataset in DATASET_FILES:
+                if not os.path.exists(source.get_guild_file(guild_id, dataset)):
+                    continue
+                data = source.load(guild_id, dataset)
+                target.save(guild_id, dataset, data)
+                migrated += 1
+                print(f"{guild_id}/{DATASET_FILES[dataset]}: {len(data)} keys")
+    finally:
+        target.close()
+    return migrated
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--root", default="guild_data", help="guild_data folder to read from")
+    parser.add_argument("--db", default=None, help="SQLite file to write (default: <root>/guild_data.sqlite3)")
+    args = parser.parse_args()
+    db_path = args.db or os.path.join(args.root, "guild_data.sqlite3")
+    migrated = migrate(args.root, db_path)
+    print(f"Migrated {migrated} dataset files into {db_path}")
+
+
+if __name__ == "__main__":
+    main()
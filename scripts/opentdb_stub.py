@@ -0,0 +1,113 @@
+"""Serve a fake OpenTDB API locally to try the trivia fetch and fallback paths without the network.
+
+Point the bot at it with OPENTDB_URL=http://127.0.0.1:8765/api.php. Modes:
+  ok          always answer with generated questions
+  rate-limit  answer with response code 5 unless a request came in at least --interval seconds ago,
+              counting /api_token.php requests like OpenTDB does
+  flaky       fail every other request with HTTP 500
+  empty       answer with response code 1 (not enough questions)
+  down        accept connections but never answer, to exercise timeouts
+
+Session tokens from /api_token.php are honoured in every mode: unknown tokens
+get response code 3, and a token that has been sent --token-limit questions
+gets code 4 until it is reset.
+
+Usage: python scripts/opentdb_stub.py [--port 8765] [--mode ok] [--interval 5] [--token-limit 200]
+"""
+import argparse
+import asyncio
+import html
+import itertools
+import secrets
+import time
+
+from aiohttp import web
+
+DIFFICULTIES = ["easy", "medium", "hard"]
+
+
+def make_results(amount, difficulty, counter):
+    results = []
+    for _ in range(amount):
+        n = next(counter)
+        level = difficulty or DIFFICULTIES[n % 3]
+        results.append({
+            "type": "multiple",
+            "difficulty": level,
+            "category": "General Knowledge",
+            # Escaped like the real API
+            "question": html.escape(f"Stub question #{n} ({level}): what's {n} + {n}?"),
+            "correct_answer": str(2 * n),
+            "incorrect_answers": [str(2 * n + 1), str(2 * n - 1), str(n)],
+        })
+    return results
+
+
+def create_app(mode, interval, token_limit):
+    counter = itertools.count(1)
+    state = {"requests": 0, "last": 0.0}
+    # Questions sent per session token
+    tokens = {}
+
+    def rate_limited():
+        now = time.monotonic()
+        limited = mode == "rate-limit" and now - state["last"] < interval
+        state["last"] = now
+        return limited
+
+    async def api_token(request):
+        print(f"token {dict(request.query)}")
+        if rate_limited():
+            return web.json_response({"response_code": 5})
+        command = request.query.get("command")
+        if command == "request":
+            token = secrets.token_hex(32)
+            tokens[token] = 0
+            return web.json_response({"response_code": 0, "response_message": "Token Generated Successfully!", "token": token})
+        token = request.query.get("token")
+        if command == "reset" and token in tokens:
+            tokens[token] = 0
+            return web.json_response({"response_code": 0, "token": token})
+        return web.json_response({"response_code": 3 if command == "reset" else 2})
+
+    async def api(request):
+        state["requests"] += 1
+        amount = min(int(request.query.get("amount", 10)), 50)
+        difficulty = request.query.get("difficulty")
+        print(f"#{state['requests']} {dict(request.query)}")
+        if mode == "down":
+            await asyncio.sleep(3600)
+        if mode == "flaky" and state["requests"] % 2:
+            return web.Response(status=500, text="stub failure")
+        if mode == "empty":
+            return web.json_response({"response_code": 1, "results": []})
+        if rate_limited():
+            return web.json_response({"response_code": 5, "results": []})
+        token = request.query.get("token")
+        if token is not None:
+            if token not in tokens:
+                return web.json_response({"response_code": 3, "results": []})
+            if tokens[token] + amount > token_limit:
+                return web.json_response({"response_code": 4, "results": []})
+            tokens[token] += amount
+        return web.json_response({"response_code": 0, "results": make_results(amount, difficulty, counter)})
+
+    app = web.Application()
+    app.router.add_get("/api.php", api)
+    app.router.add_get("/api_token.php", api_token)
+    return app
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--mode", default="ok", choices=["ok", "rate-limit", "flaky", "empty", "down"])
+    parser.add_argument("--interval", type=float, default=5.0, help="seconds between requests in rate-limit mode")
+    parser.add_argument("--token-limit", type=int, default=200, help="questions a session token gets before response code 4")
+    args = parser.parse_args()
+    web.run_app(create_app(args.mode, args.interval, args.token_limit), host=args.host, port=args.port)
+
+
+if __name__ == "__main__":
+    main()
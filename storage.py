@@ -0,0 +1,583 @@
+import asyncio
+import inspect
+import json
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+
+
+def load_json_file(filepath, default=None):
+    if os.path.exists(filepath):
+        with open(filepath, "r", encoding="utf-8") as file:
+            return json.load(file)
+    return default if default is not None else {}
+
+def serialize_json(data):
+    return json.dumps(data, indent=4)
+
+def write_file_atomic(filepath, text):
+    """Write text (or bytes) next to filepath and swap it in, so readers never see a partial file."""
+    directory = os.path.dirname(filepath) or "."
+    os.makedirs(directory, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=".", suffix=".tmp")
+    try:
+        if isinstance(text, bytes):
+            file = os.fdopen(fd, "wb")
+        else:
+            file = os.fdopen(fd, "w", encoding="utf-8")
+        with file:
+            file.write(text)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(tmp_path, filepath)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+def save_json_file(filepath, data):
+    write_file_atomic(filepath, serialize_json(data))
+
+
+# Per-guild datasets and the file each one lives in for the JSON backend
+DATASET_FILES = {
+    "game_usernames": "game_usernames.json",
+    "class_routine": "class_routine.json",
+    "activity_data": "activity_data.json",
+    "voice_activity_data": "voice_activity_data.json",
+    "mcq_scores": "mcq_scores.json",
+    "promotion_settings": "promotion_settings.json",
+    "trivia_session": "trivia_session.json",
+    "trivia_seen": "trivia_seen.json",
+}
+
+
+class JsonBackend:
+    """One JSON file per guild and dataset under guild_data/<guild_id>/."""
+
+    name = "json"
+    # Saves always write the whole dataset, whatever keys changed
+    saves_keys = False
+
+    def __init__(self, root):
+        self.root = root
+
+    def get_guild_file(self, guild_id, dataset):
+        return os.path.join(self.root, str(guild_id), DATASET_FILES[dataset])
+
+    def load(self, guild_id, dataset):
+        return load_json_file(self.get_guild_file(guild_id, dataset), default={})
+
+    def save(self, guild_id, dataset, data, keys=None):
+        # A JSON file can only be rewritten as a whole, changed keys don't help
+        save_json_file(self.get_guild_file(guild_id, dataset), data)
+
+    def close(self):
+        pass
+
+
+class SqliteBackend:
+    """All guilds in one SQLite database, one row per top-level key of a dataset.
+
+    Saving with a set of changed keys only upserts (or deletes) those rows, so
+    bumping one user's counter no longer rewrites the whole dataset.
+    """
+
+    name = "sqlite"
+    saves_keys = True
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = None
+
+    def _connection(self):
+        # Opened on first use, so merely importing the bot (as render worker processes do) doesn't
+        if self._conn is None:
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            conn = sqlite3.connect(self.path, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS guild_data ("
+                "guild_id TEXT NOT NULL, dataset TEXT NOT NULL, key TEXT NOT NULL, value TEXT NOT NULL, "
+                "PRIMARY KEY (guild_id, dataset, key)) WITHOUT ROWID"
+            )
+            conn.commit()
+            self._conn = conn
+        return self._conn
+
+    def load(self, guild_id, dataset):
+        with self._lock:
+            rows = self._connection().execute(
+                "SELECT key, value FROM guild_data WHERE guild_id = ? AND dataset = ?",
+                (str(guild_id), dataset)
+            ).fetchall()
+        return {key: json.loads(value) for key, value in rows}
+
+    def save(self, guild_id, dataset, data, keys=None):
+        guild_id = str(guild_id)
+        if keys is None:
+            rows = [(guild_id, dataset, key, json.dumps(value)) for key, value in list(data.items())]
+            deleted = []
+        else:
+            rows = [(guild_id, dataset, key, json.dumps(data[key])) for key in keys if key in data]
+            deleted = [(guild_id, dataset, key) for key in keys if key not in data]
+        with self._lock, self._connection() as conn:
+            if keys is None:
+                conn.execute(
+                    "DELETE FROM guild_data WHERE guild_id = ? AND dataset = ?", (guild_id, dataset)
+                )
+            conn.executemany(
+                "INSERT INTO guild_data (guild_id, dataset, key, value) VALUES (?, ?, ?, ?) "
+                "ON CONFLICT (guild_id, dataset, key) DO UPDATE SET value = excluded.value",
+                rows
+            )
+            conn.executemany(
+                "DELETE FROM guild_data WHERE guild_id = ? AND dataset = ? AND key = ?", deleted
+            )
+
+    def close(self):
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+
+class JournalBackend:
+    """JSON snapshots plus an append-only journal per guild dataset.
+
+    Saving changed keys appends one small record per key to
+    guild_data/<guild_id>/<dataset>.journal instead of rewriting the snapshot.
+    Loading replays the journal on top of the snapshot. Once a journal is
+    larger than both `compact_bytes` and its snapshot it is folded into a new
+    snapshot, so a load never reads much more than twice the data. Compaction
+    works from what is on disk, so replaying a journal that survived a crash
+    mid-compaction gives the same result.
+    """
+
+    name = "journal"
+    saves_keys = True
+
+    def __init__(self, root, compact_bytes=1024 * 1024):
+        self.snapshots = JsonBackend(root)
+        self.compact_bytes = compact_bytes
+        self.journal_bytes = {}
+        self.snapshot_bytes = {}
+        self.compactions = 0
+        self._locks = {}
+        self._locks_lock = threading.Lock()
+
+    def get_journal_file(self, guild_id, dataset):
+        return os.path.splitext(self.snapshots.get_guild_file(guild_id, dataset))[0] + ".journal"
+
+    def _target_lock(self, guild_id, dataset):
+        # Appends and compactions of one journal must not interleave
+        with self._locks_lock:
+            return self._locks.setdefault((guild_id, dataset), threading.Lock())
+
+    def _file_size(self, path):
+        return os.path.getsize(path) if os.path.exists(path) else 0
+
+    def _replay(self, guild_id, dataset):
+        data = self.snapshots.load(guild_id, dataset)
+        torn = False
+        path = self.get_journal_file(guild_id, dataset)
+        if os.path.exists(path):
+            with open(path, "r", encoding="utf-8") as file:
+                for line in file:
+                    if not line.endswith("\n"):
+                        # Last append was cut short by a crash
+                        torn = True
+                        break
+                    record = json.loads(line)
+                    if "replace" in record:
+                        data = record["replace"]
+                    elif record.get("del"):
+                        data.pop(record["k"], None)
+                    else:
+                        data[record["k"]] = record["v"]
+        return data, torn
+
+    def _needs_compaction(self, target):
+        return self.journal_bytes.get(target, 0) >= max(self.compact_bytes, self.snapshot_bytes.get(target, 0))
+
+    def load(self, guild_id, dataset):
+        target = (guild_id, dataset)
+        with self._target_lock(guild_id, dataset):
+            data, torn = self._replay(guild_id, dataset)
+            self.journal_bytes[target] = self._file_size(self.get_journal_file(guild_id, dataset))
+            self.snapshot_bytes[target] = self._file_size(self.snapshots.get_guild_file(guild_id, dataset))
+            if torn or self._needs_compaction(target):
+                self._compact(guild_id, dataset)
+        return data
+
+    def save(self, guild_id, dataset, data, keys=None):
+        target = (guild_id, dataset)
+        if keys is None:
+            records = [{"replace": data}]
+        else:
+            records = [{"k": key, "v": data[key]} if key in data else {"k": key, "del": True} for key in keys]
+        text = "".join(json.dumps(record) + "\n" for record in records)
+        path = self.get_journal_file(guild_id, dataset)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with self._target_lock(guild_id, dataset):
+            if target not in self.journal_bytes:
+                self.journal_bytes[target] = self._file_size(path)
+                self.snapshot_bytes[target] = self._file_size(self.snapshots.get_guild_file(guild_id, dataset))
+            with open(path, "a", encoding="utf-8") as file:
+                file.write(text)
+                file.flush()
+                os.fsync(file.fileno())
+            self.journal_bytes[target] += len(text.encode("utf-8"))
+            if self._needs_compaction(target):
+                self._compact(guild_id, dataset)
+
+    def compact(self, guild_id, dataset):
+        with self._target_lock(guild_id, dataset):
+            self._compact(guild_id, dataset)
+
+    def _compact(self, guild_id, dataset):
+        data, _ = self._replay(guild_id, dataset)
+        self.snapshots.save(guild_id, dataset, data)
+        path = self.get_journal_file(guild_id, dataset)
+        if os.path.exists(path):
+            os.remove(path)
+        self.journal_bytes[(guild_id, dataset)] = 0
+        self.snapshot_bytes[(guild_id, dataset)] = self._file_size(self.snapshots.get_guild_file(guild_id, dataset))
+        self.compactions += 1
+
+    def close(self):
+        pass
+
+
+def create_backend(name, root, sqlite_path=None, compact_bytes=1024 * 1024):
+    if name == "json":
+        return JsonBackend(root)
+    if name == "journal":
+        return JournalBackend(root, compact_bytes)
+    if name == "sqlite":
+        return SqliteBackend(sqlite_path or os.path.join(root, "guild_data.sqlite3"))
+    raise ValueError(f"Unknown storage backend: {name}")
+
+
+class AsyncStorage:
+    """Runs a storage backend in worker threads.
+
+    Saves of the same guild dataset are coalesced: while one write is running,
+    later saves only replace the pending data (and merge their changed keys),
+    and every waiter is released once a write containing its data is stored.
+    The data is copied on the event loop when `save` is called, worker threads
+    only ever see those copies and never the dicts the loop keeps changing.
+    """
+
+    def __init__(self, backend):
+        self.backend = backend
+        self._pending = {}
+        self._writers = {}
+        self.writes = 0
+        self.coalesced = 0
+
+    async def load(self, guild_id, dataset):
+        await self.wait_for_writes(guild_id, dataset)
+        return await asyncio.to_thread(self.backend.load, guild_id, dataset)
+
+    async def wait_for_writes(self, guild_id, dataset):
+        """Wait until saves queued for the guild dataset are written, so a load sees them."""
+        target = (guild_id, dataset)
+        while target in self._writers:
+            await asyncio.wait({self._writers[target]})
+
+    def _snapshot(self, data, keys):
+        """Copy the part of `data` a save needs, the C JSON encoder keeps this cheap."""
+        if keys is not None and self.backend.saves_keys:
+            data = {key: data[key] for key in keys if key in data}
+        return json.loads(json.dumps(data))
+
+    async def save(self, guild_id, dataset, data, keys=None):
+        target = (guild_id, dataset)
+        keys = set(keys) if keys is not None else None
+        snapshot = self._snapshot(data, keys)
+        pending = self._pending.get(target)
+        if pending is not None:
+            if keys is None or not self.backend.saves_keys:
+                pending[0] = snapshot
+            else:
+                # Only the changed keys were copied, apply them to what is queued
+                for key in keys:
+                    if key in snapshot:
+                        pending[0][key] = snapshot[key]
+                    else:
+                        pending[0].pop(key, None)
+            pending[1] = None if pending[1] is None or keys is None else pending[1] | keys
+            self.coalesced += 1
+            future = pending[2]
+        else:
+            future = asyncio.get_running_loop().create_future()
+            self._pending[target] = [snapshot, keys, future]
+            if target not in self._writers:
+                self._writers[target] = asyncio.create_task(self._drain(target))
+        await asyncio.shield(future)
+
+    async def _drain(self, target):
+        guild_id, dataset = target
+        try:
+            while target in self._pending:
+                data, keys, future = self._pending.pop(target)
+                try:
+                    await asyncio.to_thread(self.backend.save, guild_id, dataset, data, keys)
+                    self.writes += 1
+                    future.set_result(None)
+                except Exception as e:
+                    future.set_exception(e)
+                    # Nobody may be awaiting anymore, don't let the error go unretrieved
+                    future.exception()
+        finally:
+            del self._writers[target]
+
+    async def drain(self):
+        """Wait until every queued save has been written."""
+        while self._writers:
+            await asyncio.gather(*self._writers.values(), return_exceptions=True)
+
+    async def close(self):
+        await self.drain()
+        self.backend.close()
+
+
+class GuildDataCache:
+    """LRU cache of guild datasets, loaded with `load` before they are used.
+
+    Keeps at most `max_entries` (dataset, guild) entries and, when `max_bytes`
+    is set, roughly that many bytes of serialized data. Entries marked dirty
+    are written back before they are evicted.
+    """
+
+    def __init__(self, storage, max_entries=250, max_bytes=0):
+        self.storage = storage
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.sizes = {}
+        self.dirty = {}
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.writebacks = 0
+
+    def _load_sized(self, dataset, guild_id):
+        data = self.storage.backend.load(guild_id, dataset)
+        size = len(json.dumps(data)) if self.max_bytes else 0
+        return data, size
+
+    def _insert(self, key, data, size):
+        if key in self.entries:
+            # Someone else loaded it while we were waiting, keep theirs
+            return self.entries[key]
+        self.entries[key] = data
+        self.sizes[key] = size
+        self.total_bytes += size
+        return data
+
+    async def load(self, dataset, guild_id):
+        key = (dataset, guild_id)
+        if key in self.entries:
+            self.hits += 1
+            self.entries.move_to_end(key)
+            return self.entries[key]
+        self.misses += 1
+        # A write-back of this entry from before it was evicted may still be running
+        await self.storage.wait_for_writes(guild_id, dataset)
+        data, size = await asyncio.to_thread(self._load_sized, dataset, guild_id)
+        data = self._insert(key, data, size)
+        await self.enforce_budget(keep=key)
+        return data
+
+    def get(self, dataset, guild_id):
+        """Synchronous access for code that already awaited `load`, never reads storage on the loop."""
+        key = (dataset, guild_id)
+        if key not in self.entries:
+            raise KeyError(f"{dataset} of guild {guild_id} is not loaded, await load() first")
+        self.hits += 1
+        self.entries.move_to_end(key)
+        return self.entries[key]
+
+    def put(self, dataset, guild_id, data):
+        key = (dataset, guild_id)
+        if key in self.entries:
+            self.total_bytes -= self.sizes.pop(key)
+            del self.entries[key]
+        return self._insert(key, data, len(json.dumps(data)) if self.max_bytes else 0)
+
+    def mark_dirty(self, dataset, guild_id):
+        key = (dataset, guild_id)
+        self.dirty[key] = self.dirty.get(key, 0) + 1
+
+    async def write_back(self, dataset, guild_id, keys=None):
+        key = (dataset, guild_id)
+        data = self.entries.get(key)
+        if data is None:
+            # Already evicted, and eviction wrote it back
+            return
+        version = self.dirty.get(key)
+        await self.storage.save(guild_id, dataset, data, keys)
+        self.writebacks += 1
+        if self.dirty.get(key) == version:
+            self.dirty.pop(key, None)
+
+    async def write_back_all(self):
+        for dataset, guild_id in list(self.dirty):
+            await self.write_back(dataset, guild_id)
+
+    def _over_budget(self):
+        if len(self.entries) > self.max_entries:
+            return True
+        return bool(self.max_bytes) and self.total_bytes > self.max_bytes
+
+    async def enforce_budget(self, keep=None):
+        while self._over_budget():
+            key = next((k for k in self.entries if k != keep), None)
+            if key is None:
+                return
+            if key in self.dirty:
+                await self.write_back(*key)
+                if key not in self.entries:
+                    continue
+                if key in self.dirty:
+                    # Changed again during the write, it's clearly still in use
+                    self.entries.move_to_end(key)
+                    continue
+            del self.entries[key]
+            self.total_bytes -= self.sizes.pop(key)
+            self.evictions += 1
+
+    def view(self, dataset):
+        return GuildDatasetView(self, dataset)
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self.entries),
+            "bytes": self.total_bytes,
+            "dirty": len(self.dirty),
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+        }
+
+
+class GuildDatasetView:
+    """Dict-like view of one dataset in the cache, keyed by guild id."""
+
+    def __init__(self, cache, dataset):
+        self.cache = cache
+        self.dataset = dataset
+
+    def __getitem__(self, guild_id):
+        return self.cache.get(self.dataset, guild_id)
+
+    def __setitem__(self, guild_id, data):
+        self.cache.put(self.dataset, guild_id, data)
+
+    def __contains__(self, guild_id):
+        return (self.dataset, guild_id) in self.cache.entries
+
+
+class WriteBehindWriter:
+    """Buffers per-guild changes in memory and persists them in batches.
+
+    Callers mark a guild (and optionally the keys that changed) as dirty; the
+    writer calls `save(guild_id, keys)` for every dirty guild either every
+    `interval` seconds or as soon as `max_pending` changes have piled up.
+    """
+
+    def __init__(self, save, interval=10.0, max_pending=500):
+        self.save = save
+        self.interval = interval
+        self.max_pending = max_pending
+        self.dirty = {}
+        self.pending = 0
+        self.flushes = 0
+        self.last_flush_latency = 0.0
+        self.max_flush_latency = 0.0
+        self._wakeup = None
+        self._stopping = False
+        self._task = None
+
+    def mark_dirty(self, guild_id, key=None):
+        keys = self.dirty.setdefault(guild_id, set())
+        if key is not None:
+            keys.add(key)
+        self.pending += 1
+        if self.pending >= self.max_pending and self._wakeup is not None:
+            self._wakeup.set()
+
+    async def flush(self):
+        if not self.dirty:
+            return
+        batch, self.dirty = self.dirty, {}
+        self.pending = 0
+        start = time.perf_counter()
+        try:
+            while batch:
+                guild_id = next(iter(batch))
+                try:
+                    result = self.save(guild_id, batch[guild_id])
+                    if inspect.isawaitable(result):
+                        await result
+                except Exception as e:
+                    print(f"Failed to flush data for guild {guild_id}: {e}")
+                    # Put the guild back so the next flush retries it
+                    self._requeue(guild_id, batch[guild_id])
+                del batch[guild_id]
+        finally:
+            # Only left over when cancelled, the next flush saves them
+            for guild_id, keys in batch.items():
+                self._requeue(guild_id, keys)
+        self.last_flush_latency = time.perf_counter() - start
+        self.max_flush_latency = max(self.max_flush_latency, self.last_flush_latency)
+        self.flushes += 1
+
+    def _requeue(self, guild_id, keys):
+        self.dirty.setdefault(guild_id, set()).update(keys)
+        self.pending += max(len(keys), 1)
+
+    async def _run(self):
+        while not self._stopping:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            await self.flush()
+
+    def start(self):
+        if self._task is None:
+            self._wakeup = asyncio.Event()
+            self._stopping = False
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            # Let a flush that is already running finish its batch instead of cancelling it
+            self._stopping = True
+            self._wakeup.set()
+            await self._task
+            self._task = None
+        await self.flush()
+
+    def stats(self):
+        return {
+            "backlog_guilds": len(self.dirty),
+            "backlog_changes": self.pending,
+            "flushes": self.flushes,
+            "last_flush_ms": self.last_flush_latency * 1000,
+            "max_flush_ms": self.max_flush_latency * 1000,
+        }
@@ -0,0 +1,624 @@
+import asyncio
+import base64
+import hashlib
+import html
+import json
+import os
+import random
+import threading
+import time
+from collections import OrderedDict, deque
+
+import aiohttp
+import numpy as np
+
+# OpenTDB category used by /gk, 9 is General Knowledge
+GENERAL_KNOWLEDGE = 9
+DIFFICULTIES = ["easy", "medium", "hard"]
+
+OPENTDB_URL = "https://opentdb.com/api.php"
+# Most questions one OpenTDB request can return
+OPENTDB_MAX_AMOUNT = 50
+
+# OpenTDB response_code values
+RESPONSE_OK = 0
+RESPONSE_NO_RESULTS = 1
+RESPONSE_INVALID_PARAMETER = 2
+RESPONSE_TOKEN_NOT_FOUND = 3
+RESPONSE_TOKEN_EMPTY = 4
+RESPONSE_RATE_LIMIT = 5
+
+FALLBACK_QUESTIONS = [
+    {
+        'question': "What is the capital of France?",
+        'answers': ["Paris", "London", "Berlin", "Madrid"],
+        'correct_index': 0,
+        'category': "Geography",
+        'difficulty': "easy"
+    },
+    {
+        'question': "What is 2 + 2?",
+        'answers': ["3", "4", "5", "6"],
+        'correct_index': 1,
+        'category': "Mathematics",
+        'difficulty': "easy"
+    }
+]
+
+
+def make_question(question_data):
+    """Turn plain-text OpenTDB style fields into the question dict the quiz views use, with shuffled answers."""
+    correct_answer = question_data['correct_answer']
+    all_answers = [correct_answer] + list(question_data['incorrect_answers'])
+    random.shuffle(all_answers)
+    return {
+        'question': question_data['question'],
+        'answers': all_answers,
+        'correct_index': all_answers.index(correct_answer),
+        'category': question_data['category'],
+        'difficulty': question_data['difficulty']
+    }
+
+def decode_question(question_data):
+    """Turn an OpenTDB result, which has HTML entities in every field, into a quiz question dict."""
+    return make_question({
+        'question': html.unescape(question_data['question']),
+        'correct_answer': html.unescape(question_data['correct_answer']),
+        'incorrect_answers': [html.unescape(ans) for ans in question_data['incorrect_answers']],
+        'category': html.unescape(question_data['category']),
+        'difficulty': question_data['difficulty']
+    })
+
+def question_fields(question):
+    """The stored form of a quiz question dict, the inverse of make_question."""
+    correct_index = question['correct_index']
+    return {
+        'question': question['question'],
+        'correct_answer': question['answers'][correct_index],
+        'incorrect_answers': [answer for i, answer in enumerate(question['answers']) if i != correct_index],
+        'category': question['category'],
+        'difficulty': question['difficulty']
+    }
+
+def question_hash(text):
+    """64-bit id of a question, from its text."""
+    return int.from_bytes(hashlib.blake2b(text.encode("utf-8"), digest_size=8).digest(), "little")
+
+
+BANK_INDEX_DTYPE = np.dtype([
+    ("offset", "<u8"),
+    ("length", "<u4"),
+    ("category", "<u2"),
+    ("difficulty", "u1"),
+    ("hash", "<u8"),
+])
+
+
+class QuestionBank:
+    """Every question ever fetched, kept on disk for when OpenTDB can't be reached.
+
+    questions.jsonl holds one question per line and is only appended to.
+    questions.idx holds a fixed-size record per line (byte offset, length,
+    category id, difficulty, question hash), and only the index is kept in
+    memory, so sampling reads just the chosen lines. The index is read on
+    first use (or by `load`). Methods block on disk I/O and are meant to be
+    called from a worker thread.
+    """
+
+    def __init__(self, folder):
+        self.folder = folder
+        self.data_path = os.path.join(folder, "questions.jsonl")
+        self.index_path = os.path.join(folder, "questions.idx")
+        self.lock = threading.Lock()
+        self.index = None
+        self.hashes = set()
+
+    def __len__(self):
+        return 0 if self.index is None else len(self.index)
+
+    def _load_locked(self):
+        if self.index is not None:
+            return
+        index = np.zeros(0, dtype=BANK_INDEX_DTYPE)
+        if os.path.exists(self.index_path):
+            raw = np.fromfile(self.index_path, dtype=np.uint8)
+            # Drop a record cut short by a crash while appending
+            usable = len(raw) - len(raw) % BANK_INDEX_DTYPE.itemsize
+            index = raw[:usable].view(BANK_INDEX_DTYPE).copy()
+        self.hashes = set(index["hash"].tolist())
+        self.index = index
+
+    def load(self):
+        with self.lock:
+            self._load_locked()
+
+    def add(self, category, questions):
+        """Store quiz question dicts fetched for an OpenTDB category id, skipping known ones. Returns how many were new."""
+        with self.lock:
+            self._load_locked()
+            lines = []
+            records = []
+            for question in questions:
+                fields = question_fields(question)
+                digest = question_hash(fields['question'])
+                if digest in self.hashes or fields['difficulty'] not in DIFFICULTIES:
+                    continue
+                self.hashes.add(digest)
+                lines.append((json.dumps(fields) + "\n").encode("utf-8"))
+                records.append((category or 0, DIFFICULTIES.index(fields['difficulty']) + 1, digest))
+            if not lines:
+                return 0
+            os.makedirs(self.folder, exist_ok=True)
+            with open(self.data_path, "ab") as file:
+                offset = file.seek(0, os.SEEK_END)
+                file.write(b"".join(lines))
+            new = np.zeros(len(lines), dtype=BANK_INDEX_DTYPE)
+            for i, (line, (category_id, difficulty, digest)) in enumerate(zip(lines, records)):
+                new[i] = (offset, len(line), category_id, difficulty, digest)
+                offset += len(line)
+            with open(self.index_path, "ab") as file:
+                file.write(new.tobytes())
+            self.index = np.concatenate([self.index, new])
+            return len(lines)
+
+    def _matching(self, category=None, difficulty=None):
+        mask = np.ones(len(self.index), dtype=bool)
+        if category:
+            mask &= self.index["category"] == category
+        if difficulty:
+            mask &= self.index["difficulty"] == DIFFICULTIES.index(difficulty) + 1
+        return mask
+
+    def count(self, category=None, difficulty=None):
+        with self.lock:
+            self._load_locked()
+            return int(self._matching(category, difficulty).sum())
+
+    def sample(self, category, difficulty, count, exclude=None):
+        """Up to `count` random distinct questions, skipping those whose hash is in `exclude`."""
+        with self.lock:
+            self._load_locked()
+            records = self.index[self._matching(category, difficulty)]
+        if not len(records):
+            return []
+        order = np.random.permutation(len(records))
+        questions = []
+        with open(self.data_path, "rb") as file:
+            for record in records[order]:
+                if exclude is not None and int(record["hash"]) in exclude:
+                    continue
+                file.seek(int(record["offset"]))
+                questions.append(make_question(json.loads(file.read(int(record["length"])))))
+                if len(questions) == count:
+                    break
+        return questions
+
+
+class SeenFilter:
+    """Which questions one user has been shown, in a fixed 2 * `size` bytes.
+
+    Two Bloom filters over question_hash, each setting `hashes` bits per
+    question by double hashing. Questions go into the current filter; once it
+    holds `capacity` the previous one is dropped and the current one takes its
+    place. So the last `capacity` to 2 * `capacity` questions are remembered,
+    older ones may come back, and the false positive rate (an unseen question
+    skipped) stays at about 2% per filter with the defaults however many
+    questions the user answers.
+    """
+
+    def __init__(self, size=1024, hashes=4, capacity=1000):
+        self.size = size
+        self.hashes = hashes
+        self.capacity = capacity
+        self.current = bytearray(size)
+        self.previous = bytearray(size)
+        self.count = 0
+
+    def _positions(self, digest):
+        bits = self.size * 8
+        step = (digest >> 32) | 1
+        return [((digest & 0xFFFFFFFF) + i * step) % bits for i in range(self.hashes)]
+
+    @staticmethod
+    def _has(bits, positions):
+        return all(bits[position >> 3] & (1 << (position & 7)) for position in positions)
+
+    def __contains__(self, digest):
+        positions = self._positions(digest)
+        return self._has(self.current, positions) or self._has(self.previous, positions)
+
+    def add(self, digest):
+        positions = self._positions(digest)
+        if self._has(self.current, positions):
+            return
+        if self.count >= self.capacity:
+            self.previous = self.current
+            self.current = bytearray(self.size)
+            self.count = 0
+        for position in positions:
+            self.current[position >> 3] |= 1 << (position & 7)
+        self.count += 1
+
+    def to_dict(self):
+        return {
+            "current": base64.b64encode(self.current).decode("ascii"),
+            "previous": base64.b64encode(self.previous).decode("ascii"),
+            "count": self.count,
+        }
+
+    @classmethod
+    def from_dict(cls, data, size=1024, hashes=4, capacity=1000):
+        seen = cls(size, hashes, capacity)
+        if data:
+            current = base64.b64decode(data["current"])
+            previous = base64.b64decode(data["previous"])
+            # Filters saved with another size can't be read, start over
+            if len(current) == size and len(previous) == size:
+                seen.current = bytearray(current)
+                seen.previous = bytearray(previous)
+                seen.count = data["count"]
+        return seen
+
+
+class OpenTDBError(Exception):
+    def __init__(self, message, response_code=None):
+        super().__init__(message)
+        self.response_code = response_code
+
+
+class OpenTDBClient:
+    """One pooled HTTP session for all OpenTDB requests, kept for the bot's lifetime.
+
+    Every request has a total timeout. Connection errors, timeouts, HTTP
+    429/5xx and OpenTDB's rate limit code (5) are retried with jittered
+    exponential backoff; other response codes raise OpenTDBError.
+    """
+
+    def __init__(self, base_url=OPENTDB_URL, timeout=10.0, max_retries=3, backoff=1.0, rate_limit_wait=5.0, token_url=None):
+        self.base_url = base_url
+        # The token endpoint sits next to api.php, also on local stubs
+        self.token_url = token_url or base_url.rsplit("/", 1)[0] + "/api_token.php"
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.rate_limit_wait = rate_limit_wait
+        self.session = None
+        self.requests = 0
+        self.retries = 0
+        self.failures = 0
+        self.rate_limited = 0
+        self.latencies = deque(maxlen=200)
+
+    def _get_session(self):
+        if self.session is None or self.session.closed:
+            self.session = aiohttp.ClientSession(
+                timeout=aiohttp.ClientTimeout(total=self.timeout),
+                connector=aiohttp.TCPConnector(limit=4, keepalive_timeout=60)
+            )
+        return self.session
+
+    def _delay(self, attempt, minimum=0.0):
+        return max(minimum, self.backoff * 2 ** attempt) * random.uniform(1.0, 1.5)
+
+    async def request(self, params, url=None):
+        """GET the API (or `url`) with `params` and return the JSON body once response_code is 0."""
+        session = self._get_session()
+        for attempt in range(self.max_retries + 1):
+            last = attempt == self.max_retries
+            self.requests += 1
+            started = time.perf_counter()
+            try:
+                async with session.get(url or self.base_url, params=params) as response:
+                    if response.status == 429 or response.status >= 500:
+                        raise aiohttp.ClientResponseError(response.request_info, response.history, status=response.status)
+                    if response.status != 200:
+                        raise OpenTDBError(f"OpenTDB returned HTTP {response.status}")
+                    data = await response.json(content_type=None)
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                self.latencies.append(time.perf_counter() - started)
+                if last:
+                    self.failures += 1
+                    raise OpenTDBError(f"OpenTDB request failed: {e!r}") from e
+                self.retries += 1
+                await asyncio.sleep(self._delay(attempt))
+                continue
+            except OpenTDBError:
+                self.failures += 1
+                raise
+            self.latencies.append(time.perf_counter() - started)
+
+            code = data.get("response_code", RESPONSE_OK)
+            if code == RESPONSE_OK:
+                return data
+            if code == RESPONSE_RATE_LIMIT and not last:
+                self.rate_limited += 1
+                self.retries += 1
+                await asyncio.sleep(self._delay(attempt, self.rate_limit_wait))
+                continue
+            self.failures += 1
+            raise OpenTDBError(f"OpenTDB response code {code}", response_code=code)
+
+    async def fetch_questions(self, category, difficulty, amount, token=None):
+        """Up to `amount` decoded multiple choice questions."""
+        params = {"amount": min(amount, OPENTDB_MAX_AMOUNT), "type": "multiple"}
+        if category:
+            params["category"] = category
+        if difficulty:
+            params["difficulty"] = difficulty
+        if token:
+            params["token"] = token
+        try:
+            data = await self.request(params)
+        except OpenTDBError as e:
+            if e.response_code == RESPONSE_NO_RESULTS:
+                return []
+            raise
+        return [decode_question(question_data) for question_data in data["results"]]
+
+    async def request_token(self):
+        """A new session token, OpenTDB won't return the same question twice for it until it runs out."""
+        data = await self.request({"command": "request"}, url=self.token_url)
+        return data["token"]
+
+    async def reset_token(self, token):
+        """Let an exhausted session token return every question again."""
+        await self.request({"command": "reset", "token": token}, url=self.token_url)
+
+    async def close(self):
+        if self.session is not None:
+            await self.session.close()
+            self.session = None
+
+    def stats(self):
+        latencies = sorted(self.latencies)
+        return {
+            "requests": self.requests,
+            "retries": self.retries,
+            "failures": self.failures,
+            "rate_limited": self.rate_limited,
+            "avg_ms": sum(latencies) / len(latencies) * 1000 if latencies else 0.0,
+            "p95_ms": latencies[int(len(latencies) * 0.95)] * 1000 if latencies else 0.0,
+            "max_ms": latencies[-1] * 1000 if latencies else 0.0,
+        }
+
+
+class TokenBucket:
+    """Allows `rate` acquisitions per second on average, with bursts of up to `capacity`."""
+
+    def __init__(self, rate, capacity=1):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.lock = asyncio.Lock()
+        self.waited = 0.0
+
+    async def acquire(self):
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                delay = (1 - self.tokens) / self.rate
+                self.waited += delay
+                await asyncio.sleep(delay)
+
+
+class TriviaGateway:
+    """Funnels every OpenTDB request through one rate limited, coalescing queue.
+
+    Callers asking for the same (category, difficulty, scope) while a request is
+    waiting for its turn are merged into that request, sized to cover all of
+    them up to OPENTDB_MAX_AMOUNT, and the results are split between them in
+    arrival order. Flexible callers (prefetch refills) come last and take
+    whatever room the others leave, down to a single question. Requests go
+    out one at a time, at most `rate` per second.
+    """
+
+    def __init__(self, fetch, rate=1 / 5, max_amount=OPENTDB_MAX_AMOUNT):
+        self.fetch = fetch
+        self.bucket = TokenBucket(rate)
+        self.max_amount = max_amount
+        self.waiting = OrderedDict()
+        self._task = None
+        self.upstream_requests = 0
+        self.callers = 0
+        self.coalesced = 0
+
+    async def fetch_questions(self, category, difficulty, amount, scope=None, flexible=False):
+        future = asyncio.get_running_loop().create_future()
+        self.waiting.setdefault((category, difficulty, scope), []).append((min(amount, self.max_amount), flexible, future))
+        self.callers += 1
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+        return await future
+
+    async def _run(self):
+        try:
+            while self.waiting:
+                await self.bucket.acquire()
+                key, waiters = next(iter(self.waiting.items()))
+                waiters[:] = [waiter for waiter in waiters if not waiter[2].done()]
+                batch = []
+                total = 0
+                # Stable sort, so callers keep their arrival order ahead of the flexible ones
+                for waiter in sorted(waiters, key=lambda waiter: waiter[1]):
+                    amount, flexible, future = waiter
+                    room = self.max_amount - total
+                    share = min(amount, room) if flexible else amount
+                    if 0 < share <= room:
+                        batch.append((share, future))
+                        total += share
+                        waiters.remove(waiter)
+                if waiters:
+                    # Whatever didn't fit goes after the other keys
+                    self.waiting.move_to_end(key)
+                else:
+                    del self.waiting[key]
+                if not batch:
+                    continue
+                self.upstream_requests += 1
+                self.coalesced += len(batch) - 1
+                try:
+                    questions = await self.fetch(*key[:2], total, key[2])
+                except Exception as e:
+                    for _, future in batch:
+                        if not future.done():
+                            future.set_exception(e)
+                    continue
+                for amount, future in batch:
+                    share, questions = questions[:amount], questions[amount:]
+                    if not future.done():
+                        future.set_result(share)
+        finally:
+            self._task = None
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+        for waiters in self.waiting.values():
+            for _, _, future in waiters:
+                future.cancel()
+        self.waiting.clear()
+
+    def stats(self):
+        return {
+            "queued": sum(len(waiters) for waiters in self.waiting.values()),
+            "upstream_requests": self.upstream_requests,
+            "callers": self.callers,
+            "coalesced": self.coalesced,
+            "rate_limit_wait": self.bucket.waited,
+        }
+
+
+class TriviaPrefetcher:
+    """Keeps decoded questions ready per (category, difficulty, scope) so /gk rarely waits on OpenTDB.
+
+    `fetch(category, difficulty, amount, scope, flexible=False)` returns a
+    list of decoded questions, the scope is passed through untouched (the bot
+    uses the guild id, so each guild draws from its own OpenTDB session
+    token). When a buffer drops below `low_water` a flexible refill of up to
+    `batch_size` questions runs in the background. A caller the buffer can't
+    cover fetches just the questions it is missing, so with a TriviaGateway
+    as `fetch`, callers short on the same key and the refill share one request.
+    """
+
+    def __init__(self, fetch, low_water=10, batch_size=20):
+        self.fetch = fetch
+        self.low_water = low_water
+        self.batch_size = batch_size
+        self.buffers = {}
+        self.refills = {}
+        self.hits = 0
+        self.misses = 0
+        self.fetched = 0
+        self.failed_refills = 0
+        self.failed_fetches = 0
+        self.skipped = 0
+
+    def _refill(self, key):
+        task = self.refills.get(key)
+        if task is None:
+            task = self.refills[key] = asyncio.create_task(self._run_refill(key))
+        return task
+
+    async def _run_refill(self, key):
+        try:
+            questions = await self.fetch(*key[:2], self.batch_size, key[2], flexible=True)
+            self.buffers.setdefault(key, deque()).extend(questions)
+            self.fetched += len(questions)
+        except Exception as e:
+            self.failed_refills += 1
+            print(f"Failed to prefetch trivia questions for {key}: {e}")
+        finally:
+            self.refills.pop(key, None)
+
+    def warm(self, category, difficulty=None, scope=None):
+        self._refill((category, difficulty, scope))
+
+    def _pop(self, buffer, count, exclude):
+        """Up to `count` questions from the front of the buffer, leaving excluded ones there for other callers."""
+        questions = []
+        skipped = []
+        while buffer and len(questions) < count:
+            question = buffer.popleft()
+            if exclude is not None and exclude(question):
+                skipped.append(question)
+            else:
+                questions.append(question)
+        buffer.extendleft(reversed(skipped))
+        self.skipped += len(skipped)
+        return questions
+
+    def _fetched(self, key, request):
+        """Put what a shortfall request got into the buffer, returns False if it failed."""
+        if request.cancelled():
+            return False
+        error = request.exception()
+        if error is not None:
+            self.failed_fetches += 1
+            print(f"Failed to fetch trivia questions for {key}: {error}")
+            return False
+        questions = request.result()
+        self.buffers.setdefault(key, deque()).extend(questions)
+        self.fetched += len(questions)
+        return True
+
+    def take_buffered(self, category, difficulty, count, scope=None, exclude=None):
+        """Up to `count` questions that are already buffered, never waits."""
+        key = (category, difficulty, scope)
+        buffer = self.buffers.setdefault(key, deque())
+        questions = self._pop(buffer, count, exclude)
+        self.hits += len(questions)
+        if len(buffer) < self.low_water:
+            self._refill(key)
+        return questions
+
+    async def take(self, category, difficulty, count, scope=None, exclude=None, timeout=None):
+        """Up to `count` questions for which `exclude(question)` is false.
+
+        Fewer only if fetching the missing ones fails or takes longer than
+        `timeout` seconds; what arrives after that is kept for later callers.
+        """
+        key = (category, difficulty, scope)
+        buffer = self.buffers.setdefault(key, deque())
+        # Refills start here first, so one can go out in the same request as our shortfall
+        questions = self.take_buffered(category, difficulty, count, scope, exclude)
+        if len(questions) < count:
+            self.misses += count - len(questions)
+            request = asyncio.ensure_future(self.fetch(category, difficulty, count - len(questions), scope))
+            try:
+                done, _ = await asyncio.wait({request}, timeout=timeout)
+            except asyncio.CancelledError:
+                # Nobody gets these now, hand them back
+                buffer.extendleft(reversed(questions))
+                request.add_done_callback(lambda request: self._fetched(key, request))
+                raise
+            if not done:
+                request.add_done_callback(lambda request: self._fetched(key, request))
+            elif self._fetched(key, request):
+                # Through the buffer, so questions this caller must skip stay there for others
+                questions += self._pop(buffer, count - len(questions), exclude)
+        return questions
+
+    async def stop(self):
+        for task in list(self.refills.values()):
+            task.cancel()
+        self.refills.clear()
+
+    def stats(self):
+        served = self.hits + self.misses
+        return {
+            "buffered": sum(len(buffer) for buffer in self.buffers.values()),
+            "refilling": len(self.refills),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / served if served else 0.0,
+            "fetched": self.fetched,
+            "failed_refills": self.failed_refills,
+            "failed_fetches": self.failed_fetches,
+            "skipped": self.skipped,
+        }
@@ -0,0 +1,279 @@
+import datetime
+import gzip
+import json
+import os
+
+import numpy as np
+
+
+def format_duration(seconds):
+    seconds = int(seconds)
+    hours, rest = divmod(seconds, 3600)
+    minutes, seconds = divmod(rest, 60)
+    if hours:
+        return f"{hours}h {minutes}m"
+    if minutes:
+        return f"{minutes}m {seconds}s"
+    return f"{seconds}s"
+
+
+class VoiceSessionTracker:
+    """Voice sessions of one guild, kept in its voice_activity_data dict.
+
+    Joins open a session keyed by (channel, member), leaves close it into a
+    [channel_id, member_id, start, end] record with epoch seconds and add its
+    duration to running per-user and per-channel totals. JSON object keys are
+    strings, so ids are stored as strings there and as ints in the records.
+
+    Closed sessions are filed under a "sessions:YYYY-MM-DD" key per UTC day they
+    ended, so saving a leave only writes that day's sessions. The keys changed
+    since the tracker was created are in `changed_session_keys`.
+    """
+
+    def __init__(self, data):
+        self.data = data
+        # Raw join/leave event logs from older versions can't be turned into sessions
+        self.dropped_legacy_log = data.pop("voice_log", None) is not None
+        self.open_sessions = data.setdefault("open_sessions", {})
+        self.changed_session_keys = set()
+        self.user_totals = data.setdefault("user_totals", {})
+        self.channel_totals = data.setdefault("channel_totals", {})
+        self.occupied_since = data.setdefault("occupied_since", {})
+
+    def join(self, channel_id, member_id, timestamp):
+        key = f"{channel_id}:{member_id}"
+        if key in self.open_sessions:
+            # We missed the leave, keep counting from the first join
+            return
+        self.occupied_since.setdefault(str(channel_id), timestamp)
+        self.open_sessions[key] = timestamp
+
+    def leave(self, channel_id, member_id, timestamp):
+        """Close the member's session, returns the session record or None if we missed the join."""
+        start = self.open_sessions.pop(f"{channel_id}:{member_id}", None)
+        if start is None:
+            return None
+        end = max(timestamp, start)
+        session = [channel_id, member_id, start, end]
+        key = session_key(end)
+        self.data.setdefault(key, []).append(session)
+        self.changed_session_keys.add(key)
+        duration = end - start
+        self.user_totals[str(member_id)] = self.user_totals.get(str(member_id), 0) + duration
+        self.channel_totals[str(channel_id)] = self.channel_totals.get(str(channel_id), 0) + duration
+        return session
+
+    def move(self, old_channel_id, new_channel_id, member_id, timestamp):
+        self.leave(old_channel_id, member_id, timestamp)
+        self.join(new_channel_id, member_id, timestamp)
+
+    def sweep(self, present, now):
+        """Reconcile open sessions with who is actually in voice.
+
+        `present` is a set of (channel_id, member_id). Sessions whose member is
+        gone (we missed the leave, e.g. while restarting) are closed at the
+        last sweep that still saw them, and members we never saw join get a
+        session starting now. Returns (closed, opened).
+        """
+        last_sweep = self.data.get("swept_at", 0)
+        closed = 0
+        for key, start in list(self.open_sessions.items()):
+            channel_id, member_id = (int(part) for part in key.split(":"))
+            if (channel_id, member_id) not in present:
+                self.leave(channel_id, member_id, max(start, min(last_sweep, now)))
+                closed += 1
+        opened = 0
+        for channel_id, member_id in present:
+            if f"{channel_id}:{member_id}" not in self.open_sessions:
+                self.join(channel_id, member_id, now)
+                opened += 1
+        occupied = {str(channel_id) for channel_id, _ in present}
+        for channel_id in list(self.occupied_since):
+            if channel_id not in occupied:
+                del self.occupied_since[channel_id]
+        self.data["swept_at"] = now
+        return closed, opened
+
+    def session_keys(self):
+        """The per-day session keys, oldest day first."""
+        return sorted(key for key in self.data if key.startswith(SESSION_KEY_PREFIX))
+
+    def closed_sessions(self, since=0):
+        """A new list of the closed sessions from the days that can end at or after `since`, oldest day first."""
+        first = session_key(since)
+        return [session for key in self.session_keys() if key >= first for session in self.data[key]]
+
+    def rotate(self, now, max_age, max_per_channel):
+        """Remove and return sessions older than max_age seconds or beyond max_per_channel per channel."""
+        cutoff = now - max_age
+        rotated = []
+        per_channel = {}
+        # Walk newest first so the per-channel cap keeps the most recent sessions
+        for key in reversed(self.session_keys()):
+            day = self.data[key]
+            kept = []
+            for session in reversed(day):
+                count = per_channel.get(session[0], 0)
+                if session[3] < cutoff or count >= max_per_channel:
+                    rotated.append(session)
+                else:
+                    per_channel[session[0]] = count + 1
+                    kept.append(session)
+            if len(kept) < len(day):
+                kept.reverse()
+                if kept:
+                    day[:] = kept
+                else:
+                    del self.data[key]
+                self.changed_session_keys.add(key)
+        rotated.reverse()
+        return rotated
+
+    def channel_emptied(self, channel_id):
+        """Return the sessions since the channel was last empty, oldest first."""
+        since = self.occupied_since.pop(str(channel_id), None)
+        if since is None:
+            return []
+        # Sessions are appended as they close, so only the last days' tails can be recent enough
+        recent = []
+        for key in reversed(self.session_keys()):
+            if key < session_key(since):
+                break
+            for session in reversed(self.data[key]):
+                if session[3] < since:
+                    break
+                if session[0] == channel_id:
+                    recent.append(session)
+        recent.sort(key=lambda session: session[3])
+        return recent
+
+    def user_total(self, member_id):
+        return self.user_totals.get(str(member_id), 0)
+
+    def channel_total(self, channel_id):
+        return self.channel_totals.get(str(channel_id), 0)
+
+
+SESSION_KEY_PREFIX = "sessions:"
+
+def session_key(timestamp):
+    day = datetime.datetime.fromtimestamp(timestamp, datetime.timezone.utc).strftime("%Y-%m-%d")
+    return f"{SESSION_KEY_PREFIX}{day}"
+
+
+def get_archive_folder(guild_folder):
+    return os.path.join(guild_folder, "voice_archive")
+
+def append_voice_archive(guild_folder, sessions):
+    """Append sessions to monthly gzip segments, voice_archive/YYYY-MM.jsonl.gz by end time."""
+    by_month = {}
+    for session in sessions:
+        month = datetime.datetime.fromtimestamp(session[3], datetime.timezone.utc).strftime("%Y-%m")
+        by_month.setdefault(month, []).append(session)
+    folder = get_archive_folder(guild_folder)
+    os.makedirs(folder, exist_ok=True)
+    for month, month_sessions in by_month.items():
+        text = "".join(json.dumps(session) + "\n" for session in month_sessions)
+        # Each append adds a gzip member, readers see them as one stream
+        with gzip.open(os.path.join(folder, f"{month}.jsonl.gz"), "at", encoding="utf-8") as file:
+            file.write(text)
+
+def load_voice_archive(guild_folder, range_start, range_end):
+    """Archived sessions from the segments that can overlap [range_start, range_end)."""
+    folder = get_archive_folder(guild_folder)
+    if not os.path.isdir(folder):
+        return []
+    first_month = datetime.datetime.fromtimestamp(range_start, datetime.timezone.utc).strftime("%Y-%m")
+    sessions = []
+    for filename in sorted(os.listdir(folder)):
+        # A session is filed under the month it ended, which is never before the range starts
+        if not filename.endswith(".jsonl.gz") or filename[:7] < first_month:
+            continue
+        try:
+            with gzip.open(os.path.join(folder, filename), "rt", encoding="utf-8") as file:
+                for line in file:
+                    session = json.loads(line)
+                    if session[2] < range_end:
+                        sessions.append(session)
+        except (EOFError, OSError, ValueError) as e:
+            # Keep whatever was readable from a segment cut short by a crash
+            print(f"Failed to read voice archive {filename}: {e}")
+    return sessions
+
+
+def sessions_array(sessions, range_start, range_end):
+    """Sessions as an int64 (n, 4) array clipped to [range_start, range_end), empty ones dropped."""
+    array = np.array(sessions, dtype=np.int64).reshape(-1, 4)
+    array[:, 2] = np.maximum(array[:, 2], range_start)
+    array[:, 3] = np.minimum(array[:, 3], range_end)
+    return array[array[:, 3] > array[:, 2]]
+
+def peak_concurrency(array):
+    """Highest number of members at once per channel id, using a sweep line over all channels."""
+    if not len(array):
+        return {}
+    channels = np.concatenate([array[:, 0], array[:, 0]])
+    times = np.concatenate([array[:, 2], array[:, 3]])
+    deltas = np.concatenate([np.ones(len(array), dtype=np.int64), -np.ones(len(array), dtype=np.int64)])
+    # By channel, then time, with leaves before joins at the same second
+    order = np.lexsort((deltas, times, channels))
+    channels = channels[order]
+    # Every channel's deltas sum to zero, so one running sum restarts at 0 per channel
+    running = np.cumsum(deltas[order])
+    starts = np.flatnonzero(np.r_[True, channels[1:] != channels[:-1]])
+    peaks = np.maximum.reduceat(running, starts)
+    return {int(channel): int(peak) for channel, peak in zip(channels[starts], peaks)}
+
+def hour_of_day_seconds(array, utc_offset=0):
+    """Voice seconds per hour of the day (0-23), for a UTC offset in seconds."""
+    if not len(array):
+        return np.zeros(24, dtype=np.int64)
+    hours = np.arange(24, dtype=np.int64) * 3600
+
+    def seconds_before(t):
+        # Seconds spent in each hour of the day between the epoch and t, shape (n, 24)
+        t = (t + utc_offset)[:, None]
+        return (t // 86400) * 3600 + np.clip(t % 86400 - hours, 0, 3600)
+
+    return (seconds_before(array[:, 3]) - seconds_before(array[:, 2])).sum(axis=0)
+
+def overlap_pairs(array):
+    """Seconds each pair of members spent in the same channel, as {(member_a, member_b): seconds}."""
+    totals = {}
+    for channel in np.unique(array[:, 0]):
+        sessions = array[array[:, 0] == channel]
+        sessions = sessions[np.argsort(sessions[:, 2], kind="stable")]
+        starts = sessions[:, 2]
+        # Session i can only overlap the sessions after it that start before it ends
+        limits = np.searchsorted(starts, sessions[:, 3], side="left")
+        counts = np.maximum(limits - np.arange(1, len(sessions) + 1), 0)
+        if not counts.sum():
+            continue
+        first = np.repeat(np.arange(len(sessions)), counts)
+        offsets = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+        second = first + 1 + offsets
+        a = sessions[first]
+        b = sessions[second]
+        overlap = np.minimum(a[:, 3], b[:, 3]) - np.maximum(a[:, 2], b[:, 2])
+        keep = (overlap > 0) & (a[:, 1] != b[:, 1])
+        low = np.minimum(a[keep, 1], b[keep, 1])
+        high = np.maximum(a[keep, 1], b[keep, 1])
+        pairs, inverse = np.unique(np.stack([low, high], axis=1), axis=0, return_inverse=True)
+        sums = np.bincount(inverse.ravel(), weights=overlap[keep], minlength=len(pairs))
+        for (member_a, member_b), seconds in zip(pairs.tolist(), sums.tolist()):
+            totals[(member_a, member_b)] = totals.get((member_a, member_b), 0) + int(seconds)
+    return totals
+
+def compute_voice_stats(sessions, range_start, range_end, utc_offset=0):
+    """Voice stats for [range_start, range_end) from [channel_id, member_id, start, end] sessions."""
+    array = sessions_array(sessions, range_start, range_end)
+    durations = array[:, 3] - array[:, 2]
+    members, member_index = np.unique(array[:, 1], return_inverse=True)
+    member_seconds = np.bincount(member_index.ravel(), weights=durations, minlength=len(members))
+    return {
+        "sessions": len(array),
+        "user_seconds": {int(m): int(t) for m, t in zip(members, member_seconds)},
+        "channel_peaks": peak_concurrency(array),
+        "hour_seconds": hour_of_day_seconds(array, utc_offset).tolist(),
+        "pairs": overlap_pairs(array),
+    }